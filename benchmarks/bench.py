@@ -0,0 +1,226 @@
+"""
+Benchmarks for the MML converter.
+
+Times convert_mml_to_html end-to-end and stage by stage on a large generated
+page, and compiles a generated site with and without shared include caches.
+Reports throughput (MB/s, pages/s) and peak memory.
+
+    python benchmarks/bench.py                        # run and print the results
+    python benchmarks/bench.py --save baseline.json   # keep the results as a baseline
+    python benchmarks/bench.py --compare baseline.json --threshold 0.1
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mml_converter as mml
+import corpus
+
+# Stages of convert_mml_to_html, in pipeline order
+stages = (
+    ("includes", mml.extract_includes),
+    ("variables", mml.extract_variables),
+    ("variable functions", mml.substitute_variable_functions),
+    ("assignments", mml.assign_variables),
+    ("hashmaps", mml.extract_hashmaps),
+    ("components", mml.extract_components),
+)
+
+def new_context():
+    return mml.CompileContext(remote_cache=mml.RemoteCache(offline=True))
+
+def best_time(function, repeat):
+    """
+    Run function repeat times and return (fastest, median) wall time in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    return min(times), statistics.median(times)
+
+def peak_memory(function):
+    """
+    Peak traced memory of one run of function, in KiB.
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+def bench_page(results, page, repeat, legacy):
+    megabytes = len(page.encode()) / 1e6
+    modes = [("tokenizer", False)] + ([("legacy", True)] if legacy else [])
+    for mode, use_legacy in modes:
+        def convert():
+            mml.convert_mml_to_html(page, use_legacy, new_context())
+        seconds, median = best_time(convert, repeat)
+        results[f"page/{mode}"] = {
+            "seconds": seconds,
+            "median": median,
+            "mb_per_s": megabytes / seconds,
+            "peak_kb": peak_memory(convert),
+        }
+
+def bench_stages(results, page, repeat):
+    """
+    Time every stage on the output of the previous one, from a fresh context each run.
+    """
+    timings = {name: [] for name, _ in stages}
+    timings["parse"] = []
+    timings["render"] = []
+    for _ in range(repeat):
+        ctx = new_context()
+        content = page
+        for name, stage in stages:
+            start_time = time.perf_counter()
+            content = stage(ctx, content)
+            timings[name].append(time.perf_counter() - start_time)
+        start_time = time.perf_counter()
+        nodes = mml.parse_mml(content)
+        timings["parse"].append(time.perf_counter() - start_time)
+        start_time = time.perf_counter()
+        mml.render_html(ctx, nodes)
+        timings["render"].append(time.perf_counter() - start_time)
+    for name, times in timings.items():
+        results[f"stage/{name}"] = {"seconds": min(times), "median": statistics.median(times)}
+
+def bench_site(results, page_files, out_dir, repeat):
+    """
+    Compile every page of a site, once with a fresh Compiler per page (every include
+    parsed again) and once with one Compiler shared by all pages.
+    """
+    def output_file(page_file):
+        return os.path.join(out_dir, os.path.basename(page_file)[:-4] + ".html")
+
+    def cold():
+        for page_file in page_files:
+            mml.Compiler(remote_cache=mml.RemoteCache(offline=True)).compile_file(page_file, output_file(page_file))
+
+    def warm():
+        compiler = mml.Compiler(remote_cache=mml.RemoteCache(offline=True))
+        for page_file in page_files:
+            compiler.compile_file(page_file, output_file(page_file))
+
+    megabytes = sum(os.path.getsize(page_file) for page_file in page_files) / 1e6
+    for name, function in (("cold", cold), ("warm", warm)):
+        seconds, median = best_time(function, repeat)
+        results[f"site/{name}"] = {
+            "seconds": seconds,
+            "median": median,
+            "pages_per_s": len(page_files) / seconds,
+            "mb_per_s": megabytes / seconds,
+            "peak_kb": peak_memory(function),
+        }
+
+def run(args):
+    results = {}
+    page = corpus.generate_page(args.size, args.depth, args.variables, args.components, args.hashmaps, seed=args.seed)
+    bench_page(results, page, args.repeat, args.legacy)
+    bench_stages(results, page, args.repeat)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus_dir = args.corpus or os.path.join(tmp_dir, "corpus")
+        page_files = corpus.generate_site(corpus_dir, args.pages, args.page_size, args.depth, args.variables,
+                                          args.components, args.hashmaps, seed=args.seed)
+        out_dir = os.path.join(tmp_dir, "out")
+        os.makedirs(out_dir)
+        bench_site(results, page_files, out_dir, args.repeat)
+
+    return {
+        "version": mml.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {name: getattr(args, name) for name in ("size", "pages", "page_size", "depth", "variables", "components", "hashmaps", "seed")},
+        "results": results,
+    }
+
+def format_result(result):
+    parts = [f"{result['seconds'] * 1000:10.2f} ms"]
+    if "mb_per_s" in result:
+        parts.append(f"{result['mb_per_s']:8.2f} MB/s")
+    if "pages_per_s" in result:
+        parts.append(f"{result['pages_per_s']:8.1f} pages/s")
+    if "peak_kb" in result:
+        parts.append(f"peak {result['peak_kb'] / 1024:.1f} MiB")
+    return "  ".join(parts)
+
+def print_results(report):
+    print(f"mml_converter {report['version']} on Python {report['python']}")
+    width = max(len(name) for name in report["results"])
+    for name, result in report["results"].items():
+        print(f"  {name:<{width}}  {format_result(result)}")
+
+# Differences smaller than this are timer noise, whatever the relative change
+noise_floor = 0.001
+
+def compare(report, baseline, threshold):
+    """
+    Print the change against a baseline report and return the names of the
+    benchmarks that got slower by more than threshold.
+    """
+    if baseline.get("options") != report["options"]:
+        print("Warning: the baseline was run with different options, results may not be comparable")
+    regressions = []
+    width = max(len(name) for name in report["results"])
+    print(f"  {'benchmark':<{width}}  {'baseline':>12}  {'current':>12}  change")
+    for name, result in report["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            print(f"  {name:<{width}}  {'-':>12}  {result['seconds'] * 1000:9.2f} ms  new")
+            continue
+        change = result["seconds"] / old["seconds"] - 1
+        marker = ""
+        if change > threshold and result["seconds"] - old["seconds"] > noise_floor:
+            marker = "  REGRESSION"
+            regressions.append(name)
+        print(f"  {name:<{width}}  {old['seconds'] * 1000:9.2f} ms  {result['seconds'] * 1000:9.2f} ms  {change:+7.1%}{marker}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the MML converter.")
+    parser.add_argument("--size", type=int, default=1_000_000, help="approximate bytes of the large page (default: 1000000)")
+    parser.add_argument("--pages", type=int, default=50, help="pages in the generated site (default: 50)")
+    parser.add_argument("--page-size", type=int, default=20_000, help="approximate bytes per site page (default: 20000)")
+    parser.add_argument("--depth", type=int, default=10, help="element nesting depth (default: 10)")
+    parser.add_argument("--variables", type=int, default=1000, help="number of variables (default: 1000)")
+    parser.add_argument("--components", type=int, default=50, help="number of components (default: 50)")
+    parser.add_argument("--hashmaps", type=int, default=50, help="number of hashmaps (default: 50)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the corpus (default: 0)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark, the fastest is reported (default: 5)")
+    parser.add_argument("--no-legacy", dest="legacy", action="store_false", help="skip the legacy regex pipeline")
+    parser.add_argument("--corpus", help="write the generated site here instead of a temporary folder")
+    parser.add_argument("--save", metavar="FILE", help="write the results to a JSON file")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a baseline JSON file written by --save")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown that counts as a regression (default: 0.10)")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    print_results(report)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\nCompared to {args.compare} (mml_converter {baseline.get('version')}):")
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) slower than the baseline by more than {args.threshold:.0%}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
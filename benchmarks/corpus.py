@@ -0,0 +1,176 @@
+"""
+Synthetic MML corpus generator for the benchmarks.
+
+Generates pages with deep nesting, many variables, components and hashmaps,
+either as a single self-contained page or as a site on disk that shares its
+declarations through file and folder includes.
+
+    python benchmarks/corpus.py out/corpus --pages 200 --variables 5000
+"""
+import argparse
+import os
+import random
+
+variable_types = ("str", "i32", "float", "bool", "list", "vec2i", "color")
+
+def variable_value(datatype, rng):
+    if datatype == "str":
+        return f'"value {rng.randrange(10 ** 6)}"'
+    if datatype == "i32":
+        return str(rng.randrange(-10 ** 6, 10 ** 6))
+    if datatype == "float":
+        return f"{rng.uniform(-1000, 1000):.4f}"
+    if datatype == "bool":
+        return rng.choice(("True", "False"))
+    if datatype == "list":
+        return str([rng.randrange(100) for _ in range(rng.randrange(1, 6))])
+    if datatype == "vec2i":
+        return f"v[{rng.randrange(100)}, {rng.randrange(100)}]"
+    return f'c["{rng.choice(("red", "green", "blue", "orange", "purple"))}"]'
+
+def generate_variables(count, rng):
+    lines = []
+    for i in range(count):
+        datatype = variable_types[i % len(variable_types)]
+        lines.append(f"static {datatype} var{i} = {variable_value(datatype, rng)}")
+    return "\n".join(lines) + "\n"
+
+def generate_hashmaps(count, keys, rng):
+    blocks = []
+    for i in range(count):
+        entries = "\n".join(f'    key{k} = "entry {rng.randrange(10 ** 6)}"' for k in range(keys))
+        blocks.append(f"map.map{i} {{\n{entries}\n}}")
+    return "\n".join(blocks) + "\n"
+
+def variable_reference(variables, rng):
+    return f":var{rng.randrange(variables)}:" if variables else "no variable"
+
+def generate_component(index, variables, rng):
+    """
+    A component that references variables, takes a title argument on every
+    third component and calls an earlier component, so calls nest without cycles.
+    """
+    title = ":title:" if index % 3 == 0 else f"Component {index}"
+    inner = component_call(rng.randrange(index), rng) if index > 0 and index % 2 == 0 else ""
+    return (
+        f"$export.comp{index}\n"
+        f"(&ct cl.[comp comp{index}]){{\n"
+        f"    (&text){{{title} {variable_reference(variables, rng)}}}.&text\n"
+        f"    (&a link.[/page/{index}] cl.[link]){{{variable_reference(variables, rng)}}}.&a\n"
+        f"    {inner}\n"
+        f"}}.&ct\n"
+        f"$/export\n"
+    )
+
+def generate_components(count, variables, rng):
+    return "".join(generate_component(i, variables, rng) for i in range(count))
+
+def component_call(index, rng):
+    if index % 3 == 0:
+        return f"(@comp{index} title.[Title {rng.randrange(20)}])"
+    return f"(@comp{index})"
+
+def generate_body(size, depth, variables, components, hashmaps, keys, rng):
+    """
+    Page body of roughly size bytes: sections nested depth levels deep, with
+    text, attributes, variable and hashmap references and component calls.
+    """
+    parts = []
+    length = 0
+    section = 0
+    while length < size:
+        lines = []
+        for level in range(depth):
+            lines.append(f"{'    ' * level}(&ct cl.[level{level}] id.[s{section}l{level}]){{")
+        indent = "    " * depth
+        for _ in range(5):
+            text = f"Section {section} value {variable_reference(variables, rng)}"
+            if hashmaps and keys:
+                text += f" and :map{rng.randrange(hashmaps)}.key{rng.randrange(keys)}:"
+            lines.append(f"{indent}(&text cl.[body]){{{text}}}.&text")
+            if components:
+                lines.append(f"{indent}{component_call(rng.randrange(components), rng)}")
+            lines.append(f"{indent}(&in type.[text] name.[field{section}])")
+            lines.append(f"{indent}!// comment {section} //!")
+        for level in reversed(range(depth)):
+            lines.append(f"{'    ' * level}}}.&ct")
+        chunk = "\n".join(lines) + "\n"
+        parts.append(chunk)
+        length += len(chunk)
+        section += 1
+    return "".join(parts)
+
+def wrap_page(body, header=""):
+    return (
+        "doc!.mml\n"
+        f"{header}"
+        "(&mml lang.[en]){\n"
+        "(&head){(&title){Benchmark}.&title}.&head\n"
+        "(&body){\n"
+        f"{body}"
+        "}.&body\n"
+        "}.&mml\n"
+    )
+
+def generate_page(size=1_000_000, depth=10, variables=1000, components=50, hashmaps=50, keys=10, seed=0):
+    """
+    One self-contained page of roughly size bytes with all declarations inline.
+    """
+    rng = random.Random(seed)
+    declarations = (
+        generate_variables(variables, rng)
+        + generate_hashmaps(hashmaps, keys, rng)
+        + generate_components(components, variables, rng)
+    )
+    return wrap_page(generate_body(size, depth, variables, components, hashmaps, keys, rng), declarations)
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+def generate_site(out_dir, pages=100, page_size=20_000, depth=10, variables=1000, components=50,
+                  hashmaps=50, keys=10, seed=0):
+    """
+    Write a site to out_dir: shared variables and hashmaps in one file each,
+    one component per file in a folder include, and pages that include all of them.
+    Returns the list of page paths.
+    """
+    rng = random.Random(seed)
+    write_file(os.path.join(out_dir, "shared", "variables.mml"), generate_variables(variables, rng))
+    write_file(os.path.join(out_dir, "shared", "maps.mml"), generate_hashmaps(hashmaps, keys, rng))
+    for i in range(components):
+        write_file(os.path.join(out_dir, "components", f"comp{i}.mml"), generate_component(i, variables, rng))
+
+    header = (
+        "!include [../shared/variables.mml]\n"
+        "!include [../shared/maps.mml]\n"
+        "!include [../components]\n"
+    )
+    page_files = []
+    for i in range(pages):
+        page_file = os.path.join(out_dir, "pages", f"page{i}.mml")
+        write_file(page_file, wrap_page(generate_body(page_size, depth, variables, components, hashmaps, keys, rng), header))
+        page_files.append(page_file)
+    return page_files
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic MML site for benchmarking.")
+    parser.add_argument("output", help="folder to write the site to")
+    parser.add_argument("--pages", type=int, default=100, help="number of pages (default: 100)")
+    parser.add_argument("--page-size", type=int, default=20_000, help="approximate bytes per page body (default: 20000)")
+    parser.add_argument("--depth", type=int, default=10, help="element nesting depth (default: 10)")
+    parser.add_argument("--variables", type=int, default=1000, help="number of shared variables (default: 1000)")
+    parser.add_argument("--components", type=int, default=50, help="number of components (default: 50)")
+    parser.add_argument("--hashmaps", type=int, default=50, help="number of hashmaps (default: 50)")
+    parser.add_argument("--keys", type=int, default=10, help="keys per hashmap (default: 10)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    args = parser.parse_args(argv)
+
+    page_files = generate_site(args.output, args.pages, args.page_size, args.depth, args.variables,
+                               args.components, args.hashmaps, args.keys, args.seed)
+    print(f"Generated {len(page_files)} pages in {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
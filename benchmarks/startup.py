@@ -0,0 +1,101 @@
+"""
+Startup benchmark for the MML converter.
+
+Measures how long `import mml_converter` takes with `python -X importtime`,
+which modules the import pulls in, and the wall time of compiling a one-line
+page from the command line, both as a script and with `python -m`. Fails when
+the import is slower than --max-ms or loads a module that the core is meant to
+import lazily.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --max-ms 40 --top 15
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+converter = os.path.join(root_dir, "mml_converter.py")
+
+# Only imported where they are first needed: remote includes, color values,
+# the serve/daemon/build commands, --profile and --optimize
+lazy_modules = ("requests", "urllib3", "colour", "http.server", "socketserver",
+                "concurrent.futures", "cProfile", "pstats", "gzip")
+
+def import_times():
+    """
+    Import mml_converter in a fresh interpreter and return its cumulative
+    import time in ms and {module: (self ms, cumulative ms)} of every module
+    it imported.
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import mml_converter"],
+        cwd=root_dir, capture_output=True, text=True, check=True,
+    )
+    modules = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[0].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        # Modules imported by site before mml_converter are not its cost
+        if name == "site":
+            modules.clear()
+            continue
+        modules[name] = (int(fields[0]) / 1000, int(fields[1]) / 1000)
+    return modules.pop("mml_converter")[1], modules
+
+def process_time(command):
+    start_time = time.perf_counter()
+    subprocess.run([sys.executable] + command, cwd=root_dir, capture_output=True, check=True)
+    return (time.perf_counter() - start_time) * 1000
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of the MML converter.")
+    parser.add_argument("--repeat", type=int, default=10, help="runs per measurement, the median is reported (default: 10)")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to list (default: 10)")
+    parser.add_argument("--max-ms", type=float, default=50.0, help="import time that counts as a regression (default: 50)")
+    args = parser.parse_args(argv)
+
+    runs = [import_times() for _ in range(args.repeat)]
+    import_ms = statistics.median(total for total, _ in runs)
+    modules = runs[-1][1]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        page_file = os.path.join(tmp_dir, "page.mml")
+        with open(page_file, "w") as f:
+            f.write("doc!.mml\n(&mml){(&body){(&text){Hello}.&text}.&body}.&mml\n")
+        arguments = [page_file, "-o", os.path.join(tmp_dir, "page.html"), "--offline"]
+        script_ms = statistics.median(process_time([converter] + arguments) for _ in range(args.repeat))
+        module_ms = statistics.median(process_time(["-m", "mml_converter"] + arguments) for _ in range(args.repeat))
+    python_ms = statistics.median(process_time(["-c", "pass"]) for _ in range(args.repeat))
+
+    print(f"  import mml_converter  {import_ms:8.2f} ms  ({len(modules)} modules)")
+    print(f"  compile one page      {script_ms:8.2f} ms  (python mml_converter.py, whole process)")
+    print(f"  compile one page      {module_ms:8.2f} ms  (python -m mml_converter, whole process)")
+    print(f"  empty interpreter     {python_ms:8.2f} ms  (python -c pass, for reference)")
+    print(f"\nSlowest imports (self time):")
+    for name, (self_ms, _) in sorted(modules.items(), key=lambda item: -item[1][0])[:args.top]:
+        print(f"  {name:<24}  {self_ms:8.2f} ms")
+
+    failures = []
+    loaded = [name for name in lazy_modules if name in modules]
+    if loaded:
+        failures.append(f"import mml_converter loads {', '.join(loaded)}, which should be imported lazily")
+    if import_ms > args.max_ms:
+        failures.append(f"import mml_converter took {import_ms:.2f} ms, more than --max-ms {args.max_ms:g}")
+    if failures:
+        print()
+        for failure in failures:
+            print(failure)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,134 +1,1202 @@
+# Only the standard library is imported here, and only what every compile needs. requests,
+# colour and the modules of the build, watch and daemon commands are imported where they
+# are first used, because on short compiles the import time would exceed the compile time.
 import re
 import os
-import requests
-from urllib.parse import urljoin
+from urllib.parse import urljoin, parse_qs
 import uuid
-from colour import Color
 import math
+import argparse
+import sys
+import time
+import json
+import ast
+import operator
+import types
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import partial, lru_cache
 
-# Global dictionaries to store variables, components, and hashmaps
-variables = {}
-components = {}
-hashmaps = {}
+__version__ = "0.0.8"
 
-# Shared contexts for components, variables, and hashmaps from included files
-shared_components = {}
-shared_variables = {}
-shared_hashmaps = {}
+class CompileContext:
+    """
+    Symbol tables and state of a single compile. Nothing is shared between contexts,
+    so separate compiles can run side by side in one process or in parallel threads.
+    """
+
+    def __init__(self, include_cache=None, base_dir=None, remote_cache=None, include_stack=(), timings=None, aliases=None,
+                 write_modules=None):
+        # Dictionaries to store variables, components, and hashmaps
+        self.variables = {}
+        self.components = {}
+        self.hashmaps = {}
+
+        # Shared contexts for components, variables, and hashmaps from included files
+        self.shared_components = {}
+        self.shared_variables = {}
+        self.shared_hashmaps = {}
+
+        # References (:name: / :map.key:) that could not be resolved in the output or in declared values
+        self.unresolved_references = set()
+
+        # Include, fetch and other errors reported while compiling
+        self.errors = []
+
+        # Inputs read by this compile: "file:<path>", "folder:<path>", "native:<name>" and "remote:<url>"
+        self.dependencies = set()
+
+        # Components, variables and hashmaps referenced by the output
+        self.used_components = set()
+        self.used_variables = set()
+        self.used_hashmaps = set()
+
+        # ("component" / "variable" / "hashmap", name) of every declaration of the page and its
+        # includes -> the include declaring it (the page itself is the first include_stack entry)
+        self.declarations = {}
+
+        # Variables and hashmaps referenced by declared values, so they count as used
+        self.declaration_references = set()
+
+        # Rendered HTML of every (component, arguments) call, reused for repeated calls
+        self.component_renders = {}
+
+        # IncludeCache shared by every compile of a Compiler, or None to parse every include from scratch
+        self.include_cache = include_cache
+
+        # Includes (resolved paths / URLs) currently being processed, to detect include cycles
+        self.include_stack = include_stack
+
+        # Directory that relative include paths are resolved against
+        self.base_dir = base_dir
+
+        # On-disk cache and HTTP session for remote and native includes
+        self.remote_cache = remote_cache if remote_cache is not None else RemoteCache()
+
+        # CompileTimings of an instrumented compile, shared with the contexts of its includes
+        self.timings = timings
+
+        # Aliases the tag and attribute names are converted with, shared with the contexts of its includes
+        self.aliases = aliases if aliases is not None else default_aliases
+
+        # Whether compiled modules of includes are written (see module_writes_enabled for the default)
+        self.write_modules = write_modules if write_modules is not None else module_writes_enabled()
+
+        # False for untrusted input, e.g. fragments posted to the render daemon: include
+        # statements are then removed and reported without reading any file or URL
+        self.allow_includes = True
+
+        # Set when a declaration is evaluated again on every compile (e.g. new uuid4), so the
+        # declarations must not be stored in a compiled module or reused from the include cache
+        self.volatile = False
+
+        # Context of the file that includes the one this context processes, whose variables
+        # (and those of its own includers) the included file can use
+        self.includer = None
+
+        # Variables of the includers read by the included file: name -> var_info, or None
+        # if it was not declared. The result of the include is only reused while they are the same.
+        self.imports = {}
+
+    def child(self, base_dir=None, include_key=None):
+        """
+        Create an empty context for processing an included file. The included file sees
+        the variables the including file has at the point of the include.
+        """
+        include_stack = self.include_stack + (include_key,) if include_key else self.include_stack
+        child = CompileContext(self.include_cache, base_dir, self.remote_cache, include_stack, self.timings, self.aliases,
+                               self.write_modules)
+        child.includer = self
+        return child
+
+# Compile instrumentation
+
+class CompileTimings:
+    """
+    Instrumentation of one compile: wall time, bytes in and out and regex passes of
+    every pipeline stage, include and component cache hits, and remote fetches.
+    Every stage, include and fetch is also kept as a Chrome trace event.
+    """
+
+    def __init__(self):
+        self.events = []
+        # Stage name -> totals of the stages of the page itself (not of its includes)
+        self.stages = {}
+        self.counters = {}
+        # (url, seconds, outcome) of every remote and native include fetched
+        self.fetches = []
+        self.depth = 0
+
+    def add_event(self, name, category, start, end, args=None):
+        event = {
+            "name": name, "cat": category, "ph": "X",
+            "ts": start * 1e6, "dur": (end - start) * 1e6,
+            "pid": os.getpid(), "tid": threading.get_ident(),
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def run(self, name, function, ctx, content):
+        """
+        Run one pipeline stage, function(ctx, content), and record it.
+        """
+        start = time.perf_counter()
+        self.depth += 1
+        try:
+            result = function(ctx, content)
+        finally:
+            self.depth -= 1
+        end = time.perf_counter()
+        args = {
+            "bytes_in": len(content.encode()) if isinstance(content, str) else 0,
+            "bytes_out": len(result.encode()) if isinstance(result, str) else 0,
+            "regex_passes": len(stage_patterns.get(name, ())),
+        }
+        self.add_event(name, "stage", start, end, args)
+        if self.depth == 0:
+            stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "bytes_in": 0, "bytes_out": 0, "regex_passes": 0})
+            stage["calls"] += 1
+            stage["seconds"] += end - start
+            for key, value in args.items():
+                stage[key] += value
+        return result
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_fetch(self, url, seconds, outcome):
+        self.fetches.append((url, seconds, outcome))
+
+    @classmethod
+    def merge(cls, timings):
+        """
+        Combine the timings of several compiles, e.g. every page of a build.
+        """
+        merged = cls()
+        for item in timings:
+            merged.events.extend(item.events)
+            merged.fetches.extend(item.fetches)
+            for name, amount in item.counters.items():
+                merged.count(name, amount)
+            for name, stage in item.stages.items():
+                total = merged.stages.setdefault(name, dict.fromkeys(stage, 0))
+                for key, value in stage.items():
+                    total[key] += value
+        return merged
+
+    def summary(self):
+        """
+        The stage totals, counters and fetches as JSON-serializable data.
+        """
+        return {
+            "total_seconds": sum(stage["seconds"] for stage in self.stages.values()),
+            "stages": self.stages,
+            "counters": self.counters,
+            "fetches": [{"url": url, "seconds": seconds, "outcome": outcome} for url, seconds, outcome in self.fetches],
+        }
+
+    def trace(self):
+        """
+        The recorded events in Chrome trace-event format (chrome://tracing, Perfetto).
+        """
+        return {"traceEvents": self.events, "displayTimeUnit": "ms"}
+
+    def format_table(self):
+        total = sum(stage["seconds"] for stage in self.stages.values()) or 1e-9
+        lines = [f"{'Stage':<20} {'Calls':>6} {'Time (ms)':>10} {'%':>6} {'In (KB)':>10} {'Out (KB)':>10} {'Regex passes':>13}"]
+        for name, stage in self.stages.items():
+            lines.append(
+                f"{name:<20} {stage['calls']:>6} {stage['seconds'] * 1000:>10.2f} {stage['seconds'] / total:>6.1%} "
+                f"{stage['bytes_in'] / 1024:>10.1f} {stage['bytes_out'] / 1024:>10.1f} {stage['regex_passes']:>13}"
+            )
+        lines.append(f"{'Total':<20} {'':>6} {total * 1000:>10.2f}")
+
+        for label, hits, misses in (("Include cache", "include cache hits", "include cache misses"),
+                                    ("Compiled modules", "compiled module hits", "compiled module misses"),
+                                    ("Component renders", "component render hits", "component render misses")):
+            hit_count = self.counters.get(hits, 0)
+            calls = hit_count + self.counters.get(misses, 0)
+            if calls:
+                lines.append(f"{label}: {hit_count} of {calls} reused ({hit_count / calls:.0%})")
+        if self.fetches:
+            lines.append("Fetches:")
+            for url, seconds, outcome in self.fetches:
+                lines.append(f"  {url}  {outcome}  {seconds * 1000:.1f} ms")
+        return '\n'.join(lines)
+
+def run_stage(ctx, name, function, content):
+    """
+    Run a pipeline stage, function(ctx, content), timing it when the compile is instrumented.
+    """
+    if ctx.timings is None:
+        return function(ctx, content)
+    return ctx.timings.run(name, function, ctx, content)
+
+def fetch_remote(ctx, url):
+    """
+    Content of a remote or native include, recording the fetch when the compile is instrumented.
+    """
+    if ctx.timings is None:
+        return ctx.remote_cache.get(url)
+    start = time.perf_counter()
+    try:
+        return ctx.remote_cache.get(url)
+    finally:
+        end = time.perf_counter()
+        outcome, seconds = ctx.remote_cache.outcomes.get(url, ("memory", end - start))
+        ctx.timings.record_fetch(url, seconds, outcome)
+        ctx.timings.add_event(url, "fetch", end - seconds, end, {"outcome": outcome})
 
 # Syntax mapping for conversion
 general_syntax_map = {
     r'\(&([a-zA-Z0-9]+)((\s+[a-zA-Z]+(\.\[[^\]]+\]|\!"[^"]*"))*)\)': r'<\1\2>',  # () -> <>
 }
 
-def process_native_include(match):
-    filename = match.group(1).strip()
-    raw_url = f'https://raw.githubusercontent.com/BridgerSilk/mml-lang/main/components/{filename}'
-    
+# Built-in element aliases (MML tag name -> HTML tag name)
+tag_aliases = {
+    "mml": "html",
+    "text": "p",
+    "ct": "div",
+    "js": "script",
+    "btn": "button",
+    "line": "hr",
+    "inct": "span",
+    "in": "input",
+}
+
+# Built-in attribute shorthands (MML attribute name -> HTML attribute name)
+attribute_aliases = {
+    "cl": "class",
+    "link": "href",
+}
+
+# Project configuration
+
+# Looked up in the folder of the page or site and its parent folders, like pyproject.toml
+project_config_name = "mml.json"
+# Aliases have to be names the tokenizer matches, and map to valid HTML names
+alias_tag_pattern = re.compile(r'[a-zA-Z][a-zA-Z0-9]*\Z')
+alias_attribute_pattern = re.compile(r'[a-zA-Z][a-zA-Z0-9_-]*\Z')
+html_tag_name_pattern = re.compile(r'[a-zA-Z][a-zA-Z0-9-]*\Z')
+html_attribute_name_pattern = re.compile(r'[^\s"\'<>/=]+\Z')
+
+class ConfigError(ValueError):
+    """
+    The project configuration is invalid.
+    """
+
+class Aliases:
+    """
+    The element aliases (MML tag name -> HTML tag name) and attribute shorthands of a
+    compile: the built-in ones, plus the given ones, which may also replace built-in
+    ones. The tokenizer and the legacy pipeline look names up in one table each, so
+    more aliases cost nothing per document. Never changed after it is created, so
+    compiles with different aliases can run side by side. Raises ConfigError for invalid names.
+    """
+    __slots__ = ("tags", "attributes", "fingerprint")
+
+    def __init__(self, tags=None, attributes=None):
+        checks = (
+            (tags or {}, alias_tag_pattern, html_tag_name_pattern, "tag"),
+            (attributes or {}, alias_attribute_pattern, html_attribute_name_pattern, "attribute"),
+        )
+        for aliases, name_pattern, target_pattern, kind in checks:
+            if not isinstance(aliases, dict):
+                raise ConfigError(f"{kind} aliases must be an object of names")
+            for name, target in aliases.items():
+                if not name_pattern.match(name):
+                    raise ConfigError(f"{name!r} cannot be used as a {kind} alias")
+                if not isinstance(target, str) or not target_pattern.match(target):
+                    raise ConfigError(f"{target!r} (alias of {name!r}) is not a valid HTML {kind} name")
+        self.tags = {**tag_aliases, **(tags or {})}
+        self.attributes = {**attribute_aliases, **(attributes or {})}
+        # Stored with everything that contains converted tags
+        tables = json.dumps([sorted(self.tags.items()), sorted(self.attributes.items())])
+        self.fingerprint = hashlib.sha256(tables.encode('utf-8')).hexdigest()
+
+# Used by compiles that are not given any aliases
+default_aliases = Aliases()
+
+def find_project_config(start_dir):
+    """
+    The nearest project_config_name in start_dir or one of its parents, or None.
+    """
+    directory = os.path.abspath(start_dir)
+    while True:
+        path = os.path.join(directory, project_config_name)
+        if os.path.isfile(path):
+            return path
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+def load_project_config(path):
+    """
+    Read a project configuration file and return the Aliases of its "tags" and "attributes":
+
+        {"tags": {"card": "article"}, "attributes": {"tgt": "target"}}
+
+    Raises ConfigError if it cannot be read or is invalid.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigError(f"cannot read {path}: {e}") from e
+    if not isinstance(config, dict):
+        raise ConfigError(f"{path} must contain an object")
+    try:
+        return Aliases(config.get("tags"), config.get("attributes"))
+    except ConfigError as e:
+        raise ConfigError(f"{path}: {e}") from e
+
+# Base URL of native includes (!include native [file.mml]); override with MML_NATIVE_URL,
+# e.g. to point at a local mirror
+native_include_url = os.environ.get("MML_NATIVE_URL", "https://raw.githubusercontent.com/BridgerSilk/mml-lang/main/components/")
+
+# Seconds a cached remote include is used before it is revalidated with the server
+default_cache_ttl = 3600
+
+def default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.environ.get("MML_CACHE_DIR") or os.path.join(cache_home, "mml")
+
+def write_bytes(path, data):
+    """
+    Replace path atomically with data, with the permissions a newly created file gets,
+    creating its folder if needed. Concurrent builds never read a half-written file.
+    """
+    folder = os.path.dirname(path) or '.'
+    os.makedirs(folder, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=folder)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    # mkstemp makes the file private, but web servers and other users of a shared cache have to read it
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(temp_path, 0o666 & ~umask)
+    os.replace(temp_path, path)
+
+def write_cache_file(path, data):
+    """
+    write_bytes() for the caches. A cache is an optimization, a read-only or full disk
+    must not fail the compile or build, so write errors only return False.
+    """
+    try:
+        write_bytes(path, data)
+    except OSError:
+        return False
+    return True
+
+class FetchError(Exception):
+    """
+    A remote or native include could not be fetched and no cached copy is available.
+    """
+
+def load_requests():
+    """
+    The requests module. Imported on first use, so compiles without remote includes
+    don't pay for it and don't need it installed.
+    """
+    try:
+        import requests
+    except ImportError as e:
+        raise FetchError("install requests to use remote includes") from e
+    return requests
+
+class RemoteCache:
+    """
+    Content-addressed on-disk cache for remote and native includes.
+    Cached copies younger than ttl seconds are used without a request, older ones are
+    revalidated with ETag / If-Modified-Since. In offline mode only cached copies are used.
+    Loaded content is also kept in memory for ttl seconds, failed fetches are tried again
+    on the next use. Requests go through one pooled HTTP session.
+    """
+
+    def __init__(self, cache_dir=None, ttl=default_cache_ttl, offline=False, timeout=10, max_workers=8):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.ttl = ttl
+        self.offline = offline
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.session = None
+        self.lock = threading.Lock()
+        # URL -> (content, time.monotonic() when it was loaded) of everything loaded by this instance
+        self.fetched = {}
+        # URL -> content or FetchError loaded by prefetch(), handed to the next get() of the URL
+        self.prefetched = {}
+        # URL -> (outcome, seconds) of the last load, e.g. ("downloaded", 0.12)
+        self.outcomes = {}
+
+    def get_session(self):
+        requests = load_requests()
+        with self.lock:
+            if self.session is None:
+                self.session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+                self.session.mount("http://", adapter)
+                self.session.mount("https://", adapter)
+            return self.session
+
+    def entry_path(self, url):
+        return os.path.join(self.cache_dir, "index", hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+    def object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[:2], digest)
+
+    def module_path(self, digest):
+        return os.path.join(self.cache_dir, "modules", digest[:2], digest + ".mmlc")
+
+    def read_entry(self, url):
+        try:
+            with open(self.entry_path(url), "r") as f:
+                entry = json.load(f)
+            with open(self.object_path(entry["content_hash"]), "r", encoding="utf-8") as f:
+                return entry, f.read()
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+    def write_entry(self, url, entry, content):
+        object_path = self.object_path(entry["content_hash"])
+        if os.path.exists(object_path) or write_cache_file(object_path, content.encode("utf-8")):
+            write_cache_file(self.entry_path(url), json.dumps(entry).encode("utf-8"))
+
+    def get(self, url):
+        """
+        Return the content of url, from memory, the disk cache or the network.
+        Raises FetchError if it is neither cached nor reachable.
+        """
+        content = self.prefetched.pop(url, None)
+        if content is None:
+            content = self.memoized(url)
+        if content is None:
+            content = self.load(url)
+        if isinstance(content, FetchError):
+            raise content
+        return content
+
+    def memoized(self, url):
+        """
+        The content of url if this instance loaded it less than ttl seconds ago, or None.
+        Also None while a prefetched result waits for get(), which reports its outcome.
+        """
+        if url in self.prefetched:
+            return None
+        loaded = self.fetched.get(url)
+        if loaded is not None and (self.offline or time.monotonic() - loaded[1] < self.ttl):
+            return loaded[0]
+        return None
+
+    def load(self, url):
+        start_time = time.perf_counter()
+        outcome = "failed"
+        try:
+            content, outcome = self.load_entry(url)
+            self.fetched[url] = (content, time.monotonic())
+            return content
+        finally:
+            self.outcomes[url] = (outcome, time.perf_counter() - start_time)
+
+    def load_entry(self, url):
+        """
+        Return (content, outcome) for url, where outcome tells where the content came from.
+        """
+        entry, content = self.read_entry(url)
+        if content is not None and (self.offline or time.time() - entry["fetched_at"] < self.ttl):
+            return content, "cached"
+        if self.offline:
+            raise FetchError(f"{url} is not cached (offline mode)")
+        requests = load_requests()
+
+        headers = {}
+        if content is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            response = self.get_session().get(url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and content is not None:
+                entry["fetched_at"] = time.time()
+                outcome = "revalidated"
+            else:
+                response.raise_for_status()
+                content = response.text
+                entry = {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "content_hash": hashlib.sha256(content.encode("utf-8")).hexdigest(),
+                    "fetched_at": time.time(),
+                }
+                outcome = "downloaded"
+        except requests.RequestException as e:
+            if content is None:
+                raise FetchError(str(e)) from e
+            # The server is unreachable, keep using the stale copy
+            return content, "stale"
+        self.write_entry(url, entry, content)
+        return content, outcome
+
+    def prefetch(self, urls):
+        """
+        Fetch several URLs concurrently. The next get() of each URL returns its content,
+        or raises its FetchError, without loading it again.
+        """
+        urls = [url for url in dict.fromkeys(urls) if url not in self.prefetched and self.memoized(url) is None]
+        if len(urls) < 2:
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls))) as executor:
+            for url, content in zip(urls, executor.map(self.try_load, urls)):
+                self.prefetched[url] = content
+
+    def try_load(self, url):
+        try:
+            return self.load(url)
+        except FetchError as e:
+            return e
+
+def remote_include_urls(mml_content):
+    """
+    URLs of the native and remote includes of a document.
+    """
+    urls = []
+    for native, path in include_source_pattern.findall(mml_content):
+        if native:
+            urls.append(native_include_url + path)
+        elif path.startswith(('http://', 'https://')):
+            urls.append(path)
+    return urls
+
+class IncludeResult:
+    """
+    Declarations exported by an included file, plus the content left over
+    once they have been extracted.
+    """
+
+    def __init__(self, content, ctx):
+        self.content = content
+        self.variables = ctx.variables
+        self.components = ctx.components
+        self.hashmaps = ctx.hashmaps
+        self.errors = ctx.errors
+        self.dependencies = ctx.dependencies
+        self.volatile = ctx.volatile
+        self.declarations = ctx.declarations
+        self.declaration_references = ctx.declaration_references
+        self.unresolved_references = ctx.unresolved_references
+        # Variables of the including files the result depends on: name -> variable_state()
+        self.imports = {name: variable_state(var_info) for name, var_info in ctx.imports.items()}
+
+class IncludeCycleError(Exception):
+    """
+    An include (directly or through other includes) includes itself.
+    """
+
+def process_include_content(ctx, included_content, base_dir=None, include_key=None):
+    """
+    Extract the declarations of an included file in a child context, so the
+    result does not depend on the page that includes it and can be reused.
+    """
+    child = ctx.child(base_dir, include_key)
+    child.volatile = bool(volatile_declaration_pattern.search(included_content))
+    # Recursively process includes in the included content
+    included_content = run_stage(child, "includes", extract_includes, included_content)
+    included_content = run_stage(child, "variables", extract_variables, included_content)
+    included_content = run_stage(child, "assignments", assign_variables, included_content)
+    included_content = run_stage(child, "components", extract_components, included_content)
+    included_content = run_stage(child, "hashmaps", extract_hashmaps, included_content)
+    return IncludeResult(included_content, child)
+
+def merge_include(ctx, result):
+    """
+    Make the declarations of an included file accessible in ctx.
+    Values are copied because the page may reassign them.
+    """
+    ctx.components.update(result.components)
+    ctx.hashmaps.update({name: dict(hashmap) for name, hashmap in result.hashmaps.items()})
+    merge_variables_from_include(ctx, {name: dict(var_info) for name, var_info in result.variables.items()})
+    ctx.errors.extend(result.errors)
+    ctx.dependencies.update(result.dependencies)
+    ctx.volatile = ctx.volatile or result.volatile
+    ctx.declarations.update(result.declarations)
+    ctx.declaration_references.update(result.declaration_references)
+    ctx.unresolved_references.update(result.unresolved_references)
+
+def list_folder_includes(path):
+    """
+    The .mml files of a folder include in a stable order, and the folders that were walked.
+    """
+    mml_files = []
+    folders = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(folder for folder in dirs if folder != module_cache_folder)
+        folders.append(root)
+        mml_files.extend(os.path.join(root, file) for file in sorted(files) if file.endswith('.mml'))
+    return mml_files, folders
+
+class IncludeCache:
+    """
+    Parsed includes (IncludeResult) reused across every compile of a Compiler.
+    Local files are keyed by resolved path and validated against their modification time
+    and size, so an edited include is parsed again. An include that uses variables of the
+    files including it is kept once per set of values it saw. Folder listings are kept until
+    one of the walked folders changes, instead of walking the folder on every reference.
+    """
+
+    # Results kept per include for different values of the variables it imports
+    max_variants = 8
+
+    def __init__(self):
+        self.results = {}
+        self.folders = {}
+        self.lock = threading.Lock()
+
+    def folder_files(self, path):
+        listing = self.folders.get(path)
+        if listing is not None:
+            mml_files, folder_mtimes = listing
+            try:
+                if all(os.stat(folder).st_mtime_ns == mtime for folder, mtime in folder_mtimes):
+                    return mml_files
+            except OSError:
+                pass
+        mml_files, folders = list_folder_includes(path)
+        self.folders[path] = (mml_files, [(folder, os.stat(folder).st_mtime_ns) for folder in folders])
+        return mml_files
+
+    def fingerprint(self, path):
+        """
+        Modification time and size of a local include (of every file, for a folder).
+        Raises FileNotFoundError if the include does not exist.
+        """
+        if os.path.isdir(path):
+            return tuple((file,) + self.fingerprint(file) for file in self.folder_files(path))
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def dependency_state(self, dependency):
+        kind, target = dependency.split(':', 1)
+        try:
+            if kind == 'file':
+                stat = os.stat(target)
+                return (stat.st_mtime_ns, stat.st_size)
+            if kind == 'folder':
+                return tuple(self.folder_files(target))
+        except OSError:
+            pass
+        return None
+
+    def get(self, key, fingerprint=None, includer=None):
+        """
+        The result stored for an include, if its source is unchanged and the variables it
+        imports have the same values in includer (the context of the including file).
+        """
+        for entry_fingerprint, result, nested in self.results.get(key, ()):
+            if entry_fingerprint != fingerprint:
+                continue
+            # Files included by the include itself must be unchanged as well
+            if any(self.dependency_state(dependency) != state for dependency, state in nested):
+                continue
+            if result.imports and (includer is None or not imports_unchanged(includer, result.imports)):
+                continue
+            return result
+        return None
+
+    def put(self, key, fingerprint, result):
+        nested = tuple(
+            (dependency, self.dependency_state(dependency))
+            for dependency in result.dependencies if dependency.startswith(('file:', 'folder:'))
+        )
+        with self.lock:
+            variants = [entry for entry in self.results.get(key, ()) if entry[1].imports != result.imports]
+            self.results[key] = [(fingerprint, result, nested)] + variants[:self.max_variants - 1]
+
+    def invalidate(self, keys=None):
+        """
+        Drop the given include keys, or everything.
+        """
+        with self.lock:
+            if keys is None:
+                self.results.clear()
+                self.folders.clear()
+            for key in keys or ():
+                self.results.pop(key, None)
+                self.folders.pop(key, None)
+
+# Compiled modules (.mmlc)
+
+# Bumped whenever the layout of a compiled module changes
+module_format = 5
+# Compiled modules of local includes are kept in this folder next to the source, like __pycache__
+module_cache_folder = "__mmlcache__"
+# Declarations that must be evaluated again on every compile (see CompileContext.volatile)
+volatile_declaration_pattern = re.compile(r'=\s*new\s+uuid')
+
+def module_writes_enabled():
+    """
+    Whether compiled modules are written when a Compiler or CompileContext is not told:
+    unless MML_DONT_WRITE_MMLC is set. --no-mmlc turns them off for one command.
+    """
+    return not os.environ.get("MML_DONT_WRITE_MMLC")
+
+def local_module_path(path):
+    """
+    Where the compiled module of a local include file or folder is stored.
+    """
+    path = path.rstrip(os.sep)
+    parent, name = os.path.split(path)
+    if os.path.isdir(path):
+        return os.path.join(parent, module_cache_folder, name + ".folder.mmlc")
+    return os.path.join(parent, module_cache_folder, os.path.splitext(name)[0] + ".mmlc")
+
+def encode_value(value):
+    """
+    JSON form of a variable or hashmap value. Lists, numbers, strings, booleans and None
+    are stored as they are, other types as a single-key object naming the type.
+    Raises TypeError for values that cannot be stored.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, list):
+        return [encode_value(item) for item in value]
+    if isinstance(value, tuple):
+        return {"tuple": [encode_value(item) for item in value]}
+    if isinstance(value, dict):
+        return {"dict": [[encode_value(key), encode_value(item)] for key, item in value.items()]}
+    if isinstance(value, (set, frozenset)):
+        return {type(value).__name__: [encode_value(item) for item in value]}
+    if isinstance(value, complex):
+        return {"complex": [value.real, value.imag]}
+    if isinstance(value, uuid.UUID):
+        return {"uuid": str(value)}
+    if is_color(value):
+        return {"color": list(value.rgb)}
+    raise TypeError(f"{type(value).__name__} values cannot be stored in a compiled module")
+
+value_decoders = {
+    "tuple": lambda items: tuple(decode_value(item) for item in items),
+    "dict": lambda items: {decode_value(key): decode_value(item) for key, item in items},
+    "set": lambda items: {decode_value(item) for item in items},
+    "frozenset": lambda items: frozenset(decode_value(item) for item in items),
+    "complex": lambda parts: complex(*parts),
+    "uuid": uuid.UUID,
+    "color": lambda rgb: load_color()(rgb=tuple(rgb)),
+}
+
+def decode_value(data):
+    if isinstance(data, list):
+        return [decode_value(item) for item in data]
+    if isinstance(data, dict):
+        (kind, payload), = data.items()
+        return value_decoders[kind](payload)
+    return data
+
+def encode_state(state):
+    """
+    JSON form of a variable_state(), None for a variable that was not declared.
+    """
+    if state is None:
+        return None
+    datatype, vartype, value = state
+    return [datatype, vartype, encode_value(value)]
+
+def decode_state(data):
+    """
+    The var_info of an encoded variable_state().
+    """
+    if data is None:
+        return None
+    datatype, vartype, value = data
+    return {"datatype": datatype, "vartype": vartype, "value": decode_value(value)}
+
+def encode_parts(parts):
+    return [encode_node(part) for part in parts]
+
+def decode_parts(data):
+    return tuple(decode_node(part) for part in data)
+
+def encode_node(node):
+    """
+    JSON form of a parsed node, so components are stored already parsed. Text is a plain string.
+    """
+    if isinstance(node, str):
+        return node
+    if isinstance(node, VariableRef):
+        return {"ref": node.name, "key": node.key}
+    if isinstance(node, Element):
+        return {
+            "tag": node.tag,
+            "attributes": [[name, encode_parts(parts)] for name, parts in node.attributes],
+            "children": [encode_node(child) for child in node.children],
+            "closed": node.closed,
+        }
+    if isinstance(node, ComponentCall):
+        return {"call": node.name, "arguments": [[name, encode_parts(parts)] for name, parts in node.arguments], "source": node.source}
+    if isinstance(node, CloseTag):
+        return {"close": node.tag}
+    return {"comment": node.value}
+
+def decode_node(data):
+    if isinstance(data, str):
+        return data
+    if "ref" in data:
+        return VariableRef(data["ref"], data["key"])
+    if "tag" in data:
+        element = Element(data["tag"], tuple((name, decode_parts(parts)) for name, parts in data["attributes"]))
+        element.children = [decode_node(child) for child in data["children"]]
+        element.closed = data["closed"]
+        return element
+    if "call" in data:
+        return ComponentCall(data["call"], tuple((name, decode_parts(parts)) for name, parts in data["arguments"]), data["source"])
+    if "close" in data:
+        return CloseTag(data["close"])
+    return Comment(data["comment"])
+
+def json_state(state):
+    """
+    A fingerprint or dependency state as it reads back from JSON (tuples become lists).
+    """
+    return json.loads(json.dumps(state))
+
+def write_module(ctx, module_path, source_state, result):
+    """
+    Store an IncludeResult as a compiled module. Includes that read remote or native
+    includes themselves, or declare values that change on every compile, are not stored.
+    Values that cannot be stored and write errors are ignored, the include is then parsed again.
+    """
+    if not ctx.write_modules:
+        return
+    if any(not dependency.startswith(('file:', 'folder:')) for dependency in result.dependencies):
+        return
+    dependency_states = ctx.include_cache if ctx.include_cache is not None else IncludeCache()
+    try:
+        module = {
+            "format": module_format,
+            "version": __version__,
+            # Components are stored parsed, with their tag names already replaced by the aliases
+            "aliases": ctx.aliases.fingerprint,
+            "source": source_state,
+            "dependencies": sorted([dependency, dependency_states.dependency_state(dependency)] for dependency in result.dependencies),
+            "content": result.content,
+            "errors": result.errors,
+            "declarations": sorted([kind, name, origin] for (kind, name), origin in result.declarations.items()),
+            "declaration_references": sorted(result.declaration_references),
+            "unresolved_references": sorted(result.unresolved_references),
+            "imports": {name: encode_state(state) for name, state in result.imports.items()},
+            # Values not needed so far are evaluated now, the module stores the results
+            "variables": {
+                name: {field: encode_value(declared_value(value)) for field, value in var_info.items()}
+                for name, var_info in result.variables.items()
+            },
+            "hashmaps": {
+                name: {key: encode_value(declared_value(value)) for key, value in hashmap.items()}
+                for name, hashmap in result.hashmaps.items()
+            },
+            "components": {
+                name: {"source": template.source, "nodes": template.encoded_nodes(ctx.aliases)} for name, template in result.components.items()
+            },
+        }
+        data = json.dumps(module, separators=(',', ':')).encode("utf-8")
+    except (TypeError, ValueError):
+        return
+    write_cache_file(module_path, data)
+
+def read_module(ctx, module_path, source_state, base_dir=None, include_key=None):
+    """
+    The IncludeResult stored in a compiled module, or None if there is no module or it
+    is out of date: written by another version, for a different source, or for
+    nested includes that changed since.
+    """
     try:
-        response = requests.get(raw_url)
-        response.raise_for_status()
-        included_content = response.text
-        # Recursively process includes inside the native component
-        included_content = extract_includes(included_content)
-        included_content = extract_variables(included_content)
-        included_content = assign_variables(included_content)
-        merge_variables_from_include(variables)
-        included_content = extract_components(included_content)
-        included_content = extract_hashmaps(included_content)
+        with open(module_path, "r", encoding="utf-8") as f:
+            module = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if module.get("format") != module_format or module.get("version") != __version__ or module.get("source") != json_state(source_state):
+        return None
+    if module.get("aliases") != ctx.aliases.fingerprint:
+        return None
+    dependency_states = ctx.include_cache if ctx.include_cache is not None else IncludeCache()
+    for dependency, state in module["dependencies"]:
+        if json_state(dependency_states.dependency_state(dependency)) != state:
+            return None
+    for name, state in module["imports"].items():
+        try:
+            if json_state(encode_state(variable_state(visible_variable(ctx, name)))) != state:
+                return None
+        except TypeError:
+            return None
+
+    child = ctx.child(base_dir, include_key)
+    child.errors.extend(module["errors"])
+    child.dependencies.update(dependency for dependency, _ in module["dependencies"])
+    child.declarations.update(((kind, name), origin) for kind, name, origin in module["declarations"])
+    child.declaration_references.update(module["declaration_references"])
+    child.unresolved_references.update(module["unresolved_references"])
+    child.imports.update((name, decode_state(state)) for name, state in module["imports"].items())
+    child.variables.update(
+        (name, {field: decode_value(value) for field, value in var_info.items()}) for name, var_info in module["variables"].items()
+    )
+    child.hashmaps.update(
+        (name, {key: decode_value(value) for key, value in hashmap.items()}) for name, hashmap in module["hashmaps"].items()
+    )
+    child.components.update(
+        (name, ComponentTemplate(name, component["source"], component["nodes"], ctx.aliases))
+        for name, component in module["components"].items()
+    )
+    return IncludeResult(module["content"], child)
+
+def load_include(ctx, include_key, read_content, base_dir=None, fingerprint=None, module=None):
+    """
+    Return the IncludeResult for an include, reusing the compiler's include cache when there is one.
+    module is the (path, source state) of the include's compiled module: an up-to-date module
+    is loaded instead of processing the source, otherwise the module is written afterwards.
+    Raises IncludeCycleError if the include is already being processed further up.
+    """
+    if include_key in ctx.include_stack:
+        cycle = ctx.include_stack[ctx.include_stack.index(include_key):] + (include_key,)
+        raise IncludeCycleError(' -> '.join(cycle))
+    if ctx.include_cache is not None:
+        result = ctx.include_cache.get(include_key, fingerprint, ctx)
+        if result is not None:
+            if ctx.timings is not None:
+                ctx.timings.count("include cache hits")
+            return result
+    if ctx.timings is not None:
+        ctx.timings.count("include cache misses")
+        start = time.perf_counter()
+    result = None
+    if module is not None:
+        result = read_module(ctx, module[0], module[1], base_dir, include_key)
+        if ctx.timings is not None:
+            ctx.timings.count("compiled module hits" if result is not None else "compiled module misses")
+    if result is None:
+        result = process_include_content(ctx, read_content(), base_dir, include_key)
+        if module is not None and not result.volatile:
+            write_module(ctx, module[0], module[1], result)
+    if ctx.timings is not None:
+        ctx.timings.add_event(include_key, "include", start, time.perf_counter())
+    if ctx.include_cache is not None and not result.volatile:
+        ctx.include_cache.put(include_key, fingerprint, result)
+    return result
+
+def resolve_include_path(ctx, path):
+    """
+    Resolve a local include path relative to the including file, falling back to the working directory.
+    """
+    if ctx.base_dir and not os.path.isabs(path):
+        candidate = os.path.join(ctx.base_dir, path)
+        if os.path.exists(candidate):
+            return candidate
+    return path
+
+def folder_include_files(ctx, path):
+    if ctx.include_cache is not None:
+        return ctx.include_cache.folder_files(path)
+    return list_folder_includes(path)[0]
+
+def record_local_dependency(ctx, path):
+    if os.path.isdir(path):
+        ctx.dependencies.add(f'folder:{path}')
+        ctx.dependencies.update(f'file:{file}' for file in folder_include_files(ctx, path))
+    else:
+        ctx.dependencies.add(f'file:{path}')
+
+def read_local_include(ctx, path):
+    if os.path.isdir(path):
+        mml_files = folder_include_files(ctx, path)
+        included_content = ''
+        for file in mml_files:
+            with open(file, 'r') as f:
+                included_content += f.read() + '\n'
         return included_content
-    except requests.RequestException as e:
-        print(f"Error fetching native component {filename}: {e}")
+    with open(path, 'r') as f:
+        return f.read()
+
+def load_remote_include(ctx, include_key, url):
+    """
+    IncludeResult of a remote or native include. It is reused while the fetched content
+    has the same hash, and its compiled module is kept in the remote cache folder under it.
+    """
+    # Content loaded less than the cache ttl ago is used without a fetch
+    content = ctx.remote_cache.memoized(url)
+    if content is None:
+        content = fetch_remote(ctx, url)
+    digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    return load_include(ctx, include_key, lambda: content, fingerprint=digest, module=(ctx.remote_cache.module_path(digest), digest))
+
+def process_native_include(ctx, match):
+    filename = match.group(1).strip()
+    raw_url = native_include_url + filename
+    ctx.dependencies.add(f'native:{filename}')
+
+    try:
+        result = load_remote_include(ctx, f'native:{filename}', raw_url)
+        merge_include(ctx, result)
+        return result.content
+    except FetchError as e:
+        ctx.errors.append(f"Error fetching native component {filename}: {e}")
+        return ''
+    except IncludeCycleError as e:
+        ctx.errors.append(f"Error: include cycle {e}")
         return ''
 
-def extract_includes(mml_content):
+# !include [path] and !include native [name] statements
+include_statement_pattern = re.compile(r'!include\s*(?:native\s*)?\[\s*(.*?)\s*\]')
+native_include_pattern = re.compile(r'!include\s+native\s*\[\s*(.*?)\s*\]')
+include_pattern = re.compile(r'!include\s*\[\s*(.*?)\s*\]')
+# Both kinds in one scan, group 1 is set for native includes
+include_source_pattern = re.compile(r'!include(?:\s+(native))?\s*\[\s*(.*?)\s*\]')
+
+def extract_includes(ctx, mml_content):
     """
     Process !include and !include native statements to make components, variables, and hashmaps accessible.
     """
+    if not ctx.allow_includes:
+        mml_content, count = include_statement_pattern.subn('', mml_content)
+        if count:
+            # Without the path, so the message does not tell which files exist
+            ctx.errors.append("Error: !include is not allowed here")
+        return mml_content
+
+    # Fetch all remote files of this document at once instead of one after another
+    ctx.remote_cache.prefetch(remote_include_urls(mml_content))
 
     # First, handle native includes
-    native_matches = re.findall(r'!include\s+native\s*\[\s*(.*?)\s*\]', mml_content)
+    native_matches = native_include_pattern.findall(mml_content)
     for match in native_matches:
-        included_content = process_native_include(re.match(r'(.*)', match))
+        included_content = process_native_include(ctx, re.match(r'(.*)', match))
         mml_content = mml_content.replace(f'!include native [{match}]', included_content)
 
     # Then handle normal local/remote includes (without .package)
-    include_matches = re.findall(r'!include\s*\[\s*(.*?)\s*\]', mml_content)
+    include_matches = include_pattern.findall(mml_content)
     for path in include_matches:
         try:
             if path.startswith(('http://', 'https://')):
                 # Handle remote files
-                response = requests.get(path)
-                response.raise_for_status()
-                included_content = response.text
+                ctx.dependencies.add(f'remote:{path}')
+                result = load_remote_include(ctx, path, path)
             else:
                 # Handle local files or folders
-                if os.path.isdir(path):
-                    included_content = ''
-                    for root, _, files in os.walk(path):
-                        for file in files:
-                            if file.endswith('.mml'):
-                                with open(os.path.join(root, file), 'r') as f:
-                                    included_content += f.read() + '\n'
-                else:
-                    with open(path, 'r') as f:
-                        included_content = f.read()
-            
-            # Recursively process includes in the included content
-            variables.update(shared_variables)
-            included_content = extract_includes(included_content)
-            included_content = extract_variables(included_content)
-            included_content = assign_variables(included_content)
-            merge_variables_from_include(variables)
-            included_content = extract_components(included_content)
-            included_content = extract_hashmaps(included_content)
+                resolved_path = os.path.abspath(resolve_include_path(ctx, path))
+                base_dir = resolved_path if os.path.isdir(resolved_path) else os.path.dirname(resolved_path)
+                record_local_dependency(ctx, resolved_path)
+                fingerprint = (ctx.include_cache if ctx.include_cache is not None else IncludeCache()).fingerprint(resolved_path)
+                module = (local_module_path(resolved_path), fingerprint)
+                result = load_include(ctx, resolved_path, lambda: read_local_include(ctx, resolved_path), base_dir, fingerprint, module)
+            merge_include(ctx, result)
 
             # Remove the include statement
             mml_content = mml_content.replace(f'!include [{path}]', '')
 
         except FileNotFoundError:
-            print(f"Error: File {path} not found.")
-        except requests.RequestException as e:
-            print(f"Error fetching {path}: {e}")
+            ctx.errors.append(f"Error: File {path} not found.")
+        except FetchError as e:
+            ctx.errors.append(f"Error fetching {path}: {e}")
+        except IncludeCycleError as e:
+            ctx.errors.append(f"Error: include cycle {e}")
 
     return mml_content
 
-def extract_variables(mml_content):
+class LazyValue:
+    """
+    A declared value that is evaluated when it is first used, so values no page
+    references are never evaluated. Only values without references are deferred,
+    they evaluate the same whenever they are needed.
+    """
+    __slots__ = ("evaluate", "source", "value")
+
+    def __init__(self, evaluate, source):
+        self.evaluate = evaluate
+        self.source = source
+        self.value = None
+
+    def get(self):
+        evaluate = self.evaluate
+        if evaluate is not None:
+            self.value = evaluate(self.source)
+            self.evaluate = None
+        return self.value
+
+def declared_value(value):
+    """
+    The value of a variable or hashmap entry, evaluating it if it was deferred.
+    """
+    return value.get() if isinstance(value, LazyValue) else value
+
+def declare(ctx, kind, name):
+    ctx.declarations[(kind, name)] = ctx.include_stack[-1] if ctx.include_stack else ''
+
+def substitute_declaration(ctx, value):
+    """
+    Substitute the variables of a declared or assigned value. The variables and
+    hashmaps it references are remembered, so they count as used. Unknown
+    variables are kept as written and recorded as unresolved.
+    """
+    def resolve(name, key, type_check):
+        ctx.declaration_references.add(name)
+        if key is None and not type_check:
+            value = lookup_reference(ctx, name)
+            if value is None:
+                ctx.unresolved_references.add(f':{name}:')
+            return value
+        return None
+    return substitute_references(value, resolve)
+
+# static <type> name = value and dynamic name = value declarations
+static_variable_pattern = re.compile(r'static\s+(str|i32|float|list|bool|nonetype|complex|vec2i|vec3i|vecf|uuid|bit|char|color)\s+([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*([^\n]+)')
+dynamic_variable_pattern = re.compile(r'dynamic\s+([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*([^\n]+)')
+
+def extract_variables(ctx, mml_content):
     """
     Extract typed variables (static/dynamic) and store in the variables dict.
     Supports static <type> name = value and dynamic name = value.
+    Static values without references are evaluated when they are first used.
     """
-    # Match static vars: static <type> name = value
-    static_matches = re.findall(r'static\s+(str|i32|float|list|bool|nonetype|complex|vec2i|vec3i|vecf|uuid|bit|char|color)\s+([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*([^\n]+)', mml_content)
-    for datatype, var_name, var_value in static_matches:
-        var_value = substitute_variables(var_value.strip())
-        evaluated_value = safe_eval(var_value, datatype)
-        variables[var_name] = {"datatype": datatype, "vartype": "static", "value": evaluated_value}
-    
-    # Match dynamic vars: dynamic name = value
-    dynamic_matches = re.findall(r'dynamic\s+([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*([^\n]+)', mml_content)
-    for var_name, var_value in dynamic_matches:
-        var_value = substitute_variables(var_value.strip())
-        evaluated_value = safe_eval(var_value, None)  # dynamic type
-        variables[var_name] = {"datatype": type_name(evaluated_value), "vartype": "dynamic", "value": evaluated_value}
+    def declare_static(match):
+        datatype, var_name, var_value = match.groups()
+        var_value = var_value.strip()
+        # new uuid values differ on every compile, a deferred one would be evaluated once and shared
+        if substitution_pattern.search(var_value) is None and volatile_declaration_pattern.search(match.group(0)) is None:
+            evaluated_value = LazyValue(partial(safe_eval, expected_type=datatype), var_value)
+        else:
+            evaluated_value = safe_eval(substitute_declaration(ctx, var_value), datatype)
+        ctx.variables[var_name] = {"datatype": datatype, "vartype": "static", "value": evaluated_value}
+        declare(ctx, "variable", var_name)
+        return ''
 
-    # Remove declarations from MML content
-    mml_content = re.sub(r'static\s+(str|i32|float|list|bool|nonetype|complex|vec2i|vec3i|vecf|uuid|bit|char|color)\s+[a-zA-Z_][a-zA-Z0-9_]*\s*=\s*[^\n]+', '', mml_content)
-    mml_content = re.sub(r'dynamic\s+[a-zA-Z_][a-zA-Z0-9_]*\s*=\s*[^\n]+', '', mml_content)
-    return mml_content
+    # Static declarations are stored and removed in the same scan
+    content = static_variable_pattern.sub(declare_static, mml_content)
 
-def assign_variables(mml_content):
-    assignment_pattern = re.compile(r'^\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*(.+)$', re.MULTILINE)
+    # Dynamic declarations are looked for in the content as written, before the static ones were removed
+    for var_name, var_value in dynamic_variable_pattern.findall(mml_content):
+        var_value = substitute_declaration(ctx, var_value.strip())
+        evaluated_value = safe_eval(var_value, None)  # dynamic type
+        ctx.variables[var_name] = {"datatype": type_name(evaluated_value), "vartype": "dynamic", "value": evaluated_value}
+        declare(ctx, "variable", var_name)
+    return dynamic_variable_pattern.sub('', content)
+
+# name = value assignments to declared variables, one per line
+assignment_pattern = re.compile(r'^\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*(.+)$', re.MULTILINE)
 
+def assign_variables(ctx, mml_content):
     def replace_assignment(match):
         var_name = match.group(1)
         var_value = match.group(2).strip()
 
-        if var_name not in variables:
+        var_info = visible_variable(ctx, var_name)
+        if var_info is None:
             return match.group(0)
-
-        var_info = variables[var_name]
-        var_value = substitute_variables(var_value)
+        if var_name not in ctx.variables:
+            # A variable of an including file, the assigned copy is exported back to it
+            var_info = ctx.variables[var_name] = dict(var_info)
+        var_value = substitute_declaration(ctx, var_value)
 
         if var_info["vartype"] == "static":
             evaluated_value = safe_eval(var_value, var_info["datatype"])
@@ -174,25 +1242,195 @@ def type_name(value):
         return "nonetype"
     return "any"
 
+def load_color():
+    """
+    The colour.Color class, imported when the first color value is created.
+    """
+    from colour import Color
+    return Color
+
+def is_color(value):
+    # Before colour is imported no value can be a Color
+    colour = sys.modules.get('colour')
+    return colour is not None and isinstance(value, colour.Color)
+
 def is_valid_color(value):
     try:
         # If this succeeds, it's a valid color
-        Color(value)
+        load_color()(value)
         return True
     except:
         return False
 
+# Sandboxed expression evaluation
+
+# Names an MML expression can use, nothing else is reachable
+expression_names = {
+    "math": math,
+    "int": int, "float": float, "str": str, "bool": bool, "complex": complex, "list": list,
+    "tuple": tuple, "set": set, "len": len, "abs": abs, "min": min, "max": max, "round": round,
+    "uuid": uuid,
+}
+# Names whose value is imported the first time an expression uses them
+lazy_expression_names = {
+    "Color": load_color,
+}
+
+class ExpressionError(ValueError):
+    """
+    An expression that is not valid or uses something the sandbox does not allow.
+    """
+
+def checked_power(base, exponent):
+    # Keep 9 ** 9 ** 9 from hanging the compiler
+    if isinstance(exponent, int) and abs(exponent) > 10000:
+        raise ExpressionError("exponent too large")
+    return base ** exponent
+
+binary_operators = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: checked_power,
+    ast.BitAnd: operator.and_, ast.BitOr: operator.or_, ast.BitXor: operator.xor,
+    ast.LShift: operator.lshift, ast.RShift: operator.rshift,
+}
+unary_operators = {ast.UAdd: operator.pos, ast.USub: operator.neg, ast.Not: operator.not_, ast.Invert: operator.invert}
+compare_operators = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge, ast.Is: operator.is_, ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b,
+}
+# format() can read attributes through its format string, so it is blocked with the private names
+blocked_attributes = {"format", "format_map"}
+
+def compile_node(node):
+    """
+    Turn an expression AST node into a function that evaluates it. Only literals,
+    operators and calls on the allowed names are accepted.
+    """
+    if isinstance(node, ast.Constant):
+        value = node.value
+        return lambda: value
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        container = {ast.List: list, ast.Tuple: tuple, ast.Set: set}[type(node)]
+        items = [compile_node(item) for item in node.elts]
+        return lambda: container(item() for item in items)
+    if isinstance(node, ast.Dict):
+        if any(key is None for key in node.keys):
+            raise ExpressionError("dict unpacking is not allowed")
+        entries = [(compile_node(key), compile_node(value)) for key, value in zip(node.keys, node.values)]
+        return lambda: {key(): value() for key, value in entries}
+    if isinstance(node, ast.Name):
+        if node.id in lazy_expression_names:
+            value = lazy_expression_names[node.id]()
+            return lambda: value
+        if node.id not in expression_names:
+            raise ExpressionError(f"unknown name {node.id}")
+        value = expression_names[node.id]
+        return lambda: value
+    if isinstance(node, ast.Attribute):
+        name = node.attr
+        if name.startswith('_') or name in blocked_attributes:
+            raise ExpressionError(f"attribute {name} is not allowed")
+        target = compile_node(node.value)
+
+        def get_attribute():
+            value = getattr(target(), name)
+            if isinstance(value, types.ModuleType):
+                raise ExpressionError(f"attribute {name} is not allowed")
+            return value
+        return get_attribute
+    if isinstance(node, ast.Call):
+        if any(isinstance(arg, ast.Starred) for arg in node.args) or any(keyword.arg is None for keyword in node.keywords):
+            raise ExpressionError("argument unpacking is not allowed")
+        function = compile_node(node.func)
+        args = [compile_node(arg) for arg in node.args]
+        kwargs = [(keyword.arg, compile_node(keyword.value)) for keyword in node.keywords]
+        return lambda: function()(*[arg() for arg in args], **{name: value() for name, value in kwargs})
+    if isinstance(node, ast.Subscript):
+        target = compile_node(node.value)
+        index = compile_node(node.slice)
+        return lambda: target()[index()]
+    if isinstance(node, ast.Slice):
+        parts = [compile_node(part) if part is not None else (lambda: None) for part in (node.lower, node.upper, node.step)]
+        return lambda: slice(*[part() for part in parts])
+    if isinstance(node, ast.BinOp) and type(node.op) in binary_operators:
+        function = binary_operators[type(node.op)]
+        left, right = compile_node(node.left), compile_node(node.right)
+        return lambda: function(left(), right())
+    if isinstance(node, ast.UnaryOp) and type(node.op) in unary_operators:
+        function = unary_operators[type(node.op)]
+        operand = compile_node(node.operand)
+        return lambda: function(operand())
+    if isinstance(node, ast.BoolOp):
+        values = [compile_node(value) for value in node.values]
+        if isinstance(node.op, ast.And):
+            def evaluate_and():
+                result = True
+                for value in values:
+                    result = value()
+                    if not result:
+                        break
+                return result
+            return evaluate_and
+
+        def evaluate_or():
+            result = False
+            for value in values:
+                result = value()
+                if result:
+                    break
+            return result
+        return evaluate_or
+    if isinstance(node, ast.Compare) and all(type(op) in compare_operators for op in node.ops):
+        left = compile_node(node.left)
+        comparisons = [(compare_operators[type(op)], compile_node(right)) for op, right in zip(node.ops, node.comparators)]
+
+        def evaluate_compare():
+            value = left()
+            for function, right in comparisons:
+                right_value = right()
+                if not function(value, right_value):
+                    return False
+                value = right_value
+            return True
+        return evaluate_compare
+    if isinstance(node, ast.IfExp):
+        test, body, orelse = compile_node(node.test), compile_node(node.body), compile_node(node.orelse)
+        return lambda: body() if test() else orelse()
+    raise ExpressionError(f"{type(node).__name__} is not allowed")
+
+@lru_cache(maxsize=4096)
+def compile_expression(source):
+    """
+    Parse an expression once and return a function that evaluates it. Sources are
+    cached, so values that are reassigned or included again are not parsed again.
+    Invalid sources are cached too and raise ExpressionError when evaluated.
+    """
+    try:
+        return compile_node(ast.parse(source.strip(), mode='eval').body)
+    except (SyntaxError, ValueError, RecursionError, MemoryError) as e:
+        message = str(e)
+
+        def fail():
+            raise ExpressionError(message)
+        return fail
+
+def evaluate_expression(source):
+    """
+    Evaluate an MML expression without eval(). Raises ExpressionError for invalid
+    or disallowed expressions, and whatever the expression itself raises.
+    """
+    return compile_expression(source)()
+
+# "(expr -> type)" and "expr -> type" casts
+cast_pattern = re.compile(
+    r'^\(?\s*(.+?)\s*->\s*(str|i32|float|list|bool|nonetype|complex|'
+    r'vec2i|vec3i|vecf|uuid|bit|char|color)\s*\)?$'
+)
+
 def safe_eval(value, expected_type=None):
 	value = value.strip()
 
-	safe_globals = {
-		"__builtins__": None,
-		"math": math,
-		"int": int, "float": float, "str": str, "bool": bool, "complex": complex, "list": list,
-		"tuple": tuple, "set": set, "len": len, "abs": abs, "min": min, "max": max, "round": round,
-		"uuid": uuid, "Color": Color,
-	}
-
 	# Handle 'new uuidX' keyword
 	if value.startswith("new "):
 		if expected_type is None or expected_type == "uuid":
@@ -213,10 +1451,7 @@ def safe_eval(value, expected_type=None):
 		return None
 
 	# --- Step 1: Handle "(expr -> type)" or "expr -> type" casts properly ---
-	cast_match = re.match(
-		r'^\(?\s*(.+?)\s*->\s*(str|i32|float|list|bool|nonetype|complex|'
-		r'vec2i|vec3i|vecf|uuid|bit|char|color)\s*\)?$', value
-	)
+	cast_match = cast_pattern.match(value)
 	if cast_match:
 		expr, cast_type = cast_match.groups()
 		expr = expr.strip()
@@ -225,7 +1460,7 @@ def safe_eval(value, expected_type=None):
 		inner_val = safe_eval(expr, None)
 		if inner_val is None:
 			try:
-				inner_val = eval(expr, safe_globals, {})
+				inner_val = evaluate_expression(expr)
 			except:
 				inner_val = expr.strip().strip('"').strip("'")
 
@@ -270,9 +1505,9 @@ def safe_eval(value, expected_type=None):
 					return chr(inner_val)
 			elif cast_type == "color":
 				if isinstance(inner_val, str):
-					return Color(inner_val)
+					return load_color()(inner_val)
 				if isinstance(inner_val, (list, tuple)) and len(inner_val) >= 3:
-					return Color(rgb=(float(inner_val[0]), float(inner_val[1]), float(inner_val[2])))
+					return load_color()(rgb=(float(inner_val[0]), float(inner_val[1]), float(inner_val[2])))
 		except Exception:
 			return None
 		return inner_val
@@ -314,15 +1549,15 @@ def safe_eval(value, expected_type=None):
 		try:
 			if value.startswith("c[") and value.endswith("]"):
 				inner = value[2:-1].strip()
-				evaluated_inner = eval(inner)
-				color_obj = Color(evaluated_inner)
+				evaluated_inner = evaluate_expression(inner)
+				color_obj = load_color()(evaluated_inner)
 				return color_obj
 		except:
 			return None
 
 	# Normal eval
 	try:
-		result = eval(value, safe_globals, {})
+		result = evaluate_expression(value)
 	except:
 		result = value.strip('"').strip("'")
 
@@ -350,181 +1585,2248 @@ def safe_eval(value, expected_type=None):
 
 	return None
 
-def merge_variables_from_include(included_vars):
+def visible_variable(ctx, name):
     """
-    Merge variables from an included MML file into the shared_variables dict.
-    Keeps the type/vartype/value structure.
+    The var_info of a variable of ctx, or of the files including it, or None.
     """
-    for var_name, var_info in included_vars.items():
-        # Only add if not already present in shared_variables
-        if var_name not in shared_variables:
-            shared_variables[var_name] = var_info
+    var_info = ctx.variables.get(name)
+    if var_info is None and ctx.includer is not None:
+        var_info = imported_variable(ctx, name)
+    return var_info
+
+def imported_variable(ctx, name):
+    """
+    The variable name as the files including ctx see it at the point of the include, or
+    None. The read is recorded in ctx.imports, because the result of the include depends on it.
+    """
+    if name not in ctx.imports:
+        ctx.imports[name] = visible_variable(ctx.includer, name)
+    return ctx.imports[name]
+
+def variable_state(var_info):
+    if var_info is None:
+        return None
+    return (var_info["datatype"], var_info["vartype"], declared_value(var_info["value"]))
+
+def imports_unchanged(ctx, imports):
+    """
+    Whether the variables an include imported (name -> variable_state) have the same values in ctx.
+    """
+    return all(variable_state(visible_variable(ctx, name)) == state for name, state in imports.items())
+
+def merge_variables_from_include(ctx, included_vars):
+    """
+    Merge variables from an included MML file into the shared_variables dict
+    and make them visible to the including file.
+    Keeps the type/vartype/value structure.
+    """
+    for var_name, var_info in included_vars.items():
+        ctx.shared_variables[var_name] = var_info
+    ctx.variables.update(included_vars)
+
+# Matches :name:, :name:?type and :map.key: references in one scan
+substitution_pattern = re.compile(r':([a-zA-Z_][a-zA-Z0-9_]*)(?:\.([a-zA-Z_][a-zA-Z0-9_]*))?(:)(?:(\?type)\b|(?!type))')
+
+def lookup_reference(ctx, name, key=None, type_check=False):
+    """
+    Resolve a variable or hashmap reference with dict lookups.
+    Returns None if the reference is unknown.
+    """
+    if key is not None:
+        hashmap = ctx.hashmaps.get(name)
+        if hashmap is None or key not in hashmap:
+            return None
+        value = declared_value(hashmap[key])
+        return type_name(value) if type_check else str(value)
+    var_info = visible_variable(ctx, name)
+    if var_info is None:
+        return None
+    if type_check:
+        return var_info["datatype"]
+    value = declared_value(var_info["value"])
+    # If it's a string, substitute raw value (no quotes)
+    return value if isinstance(value, str) else str(value)
+
+def substitute_references(mml_content, resolve):
+    """
+    Replace every reference in a single scan. resolve(name, key, type_check) returns
+    the replacement text, or None to leave the reference as written.
+    """
+    pieces = []
+    position = 0
+    match = substitution_pattern.search(mml_content)
+    while match:
+        replacement = resolve(match.group(1), match.group(2), match.group(4) is not None)
+        if replacement is None:
+            # Keep the reference, but let its closing colon open the next one (:a:b:)
+            resume = match.start(3)
+            pieces.append(mml_content[position:resume])
         else:
-            # Optional: could override if you want included file to replace
-            shared_variables[var_name] = var_info
-
-def substitute_variables(mml_content):
-	for var_name, var_info in variables.items():
-		value = var_info["value"]
-		# If it's a string, substitute raw value (no quotes)
-		if isinstance(value, str):
-			replacement = value
-		else:
-			replacement = str(value)
-		mml_content = re.sub(f':{var_name}:(?!type)', replacement, mml_content)
-	return mml_content
-
-def substitute_variable_functions(mml_content):
-    for var_name, var_info in variables.items():
-        datatype = var_info["datatype"]
-        mml_content = re.sub(rf':{var_name}:\?type\b', datatype, mml_content)
-    return mml_content
+            pieces.append(mml_content[position:match.start()])
+            pieces.append(replacement)
+            resume = match.end()
+        position = resume
+        match = substitution_pattern.search(mml_content, resume)
+    if not pieces:
+        return mml_content
+    pieces.append(mml_content[position:])
+    return ''.join(pieces)
+
+def substitute_variable_functions(ctx, mml_content):
+    def resolve(name, key, type_check):
+        if key is None and type_check:
+            replacement = lookup_reference(ctx, name, type_check=True)
+            if replacement is not None:
+                ctx.used_variables.add(name)
+            return replacement
+        return None
+    return substitute_references(mml_content, resolve)
+
+def substitute_output_references(ctx, mml_content):
+    """
+    Substitute all remaining references in the output and record the unresolved ones.
+    """
+    def resolve(name, key, type_check):
+        replacement = lookup_reference(ctx, name, key, type_check)
+        if replacement is None:
+            ctx.unresolved_references.add(f':{name}.{key}:' if key else f':{name}:')
+        elif key is None:
+            ctx.used_variables.add(name)
+        else:
+            ctx.used_hashmaps.add(name)
+        return replacement
+    return substitute_references(mml_content, resolve)
+
+def evaluate_hashmap_value(value):
+    try:
+        return evaluate_expression(value)
+    except:
+        return value.strip().strip('"').strip("'")
+
+# map.name { key = value ... } declarations and their entries
+hashmap_pattern = re.compile(r'map\.([a-zA-Z_][a-zA-Z0-9_]*)\s*\{(.*?)\}', re.DOTALL)
+hashmap_entry_pattern = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*([^\n]+)')
 
-def extract_hashmaps(mml_content):
+def extract_hashmaps(ctx, mml_content):
     """
-    Extract hashmaps from the MML content and store them in the global hashmaps dictionary.
+    Extract hashmaps from the MML content and store them in the hashmaps dictionary of the compile context.
+    Values without references are evaluated when they are first used.
     """
-    map_matches = re.findall(r'map\.([a-zA-Z_][a-zA-Z0-9_]*)\s*\{(.*?)\}', mml_content, re.DOTALL)
-    for map_name, map_body in map_matches:
+    def declare_hashmap(match):
+        map_name, map_body = match.groups()
         hashmap = {}
-        entries = re.findall(r'([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*([^\n]+)', map_body)
-        for key, value in entries:
-            value = substitute_variables(value.strip())
-            try:
-                evaluated_value = eval(value)
-            except:
-                evaluated_value = value.strip().strip('"').strip("'")
-            hashmap[key] = evaluated_value
-        hashmaps[map_name] = hashmap
-    mml_content = re.sub(r'map\.([a-zA-Z_][a-zA-Z0-9_]*)\s*\{.*?\}', '', mml_content, flags=re.DOTALL)
-    return mml_content
+        for key, value in hashmap_entry_pattern.findall(map_body):
+            value = value.strip()
+            if substitution_pattern.search(value) is None:
+                hashmap[key] = LazyValue(evaluate_hashmap_value, value)
+            else:
+                hashmap[key] = evaluate_hashmap_value(substitute_declaration(ctx, value))
+        ctx.hashmaps[map_name] = hashmap
+        declare(ctx, "hashmap", map_name)
+        return ''
+    return hashmap_pattern.sub(declare_hashmap, mml_content)
 
-def substitute_hashmaps(mml_content):
+class ComponentTemplate:
     """
-    Substitute hashmaps in the MML content with their values.
+    A component extracted from its $export block. The node tree is parsed when the
+    component is first rendered, so components no page calls are never parsed. It is
+    shared by every page that uses the component and is never modified, references
+    are resolved while rendering. The legacy HTML is converted on first use. Both
+    are kept with the fingerprint of the Aliases they were converted with, and
+    converted again for a compile with different aliases.
     """
-    for map_name, hashmap in hashmaps.items():
-        for key, value in hashmap.items():
-            mml_content = re.sub(f':{map_name}\.{key}:', str(value), mml_content)
-    return mml_content
+    __slots__ = ("name", "source", "_nodes", "_encoded_nodes", "_calls", "_legacy_html")
+
+    def __init__(self, name, source, encoded_nodes=None, aliases=default_aliases):
+        self.name = name
+        self.source = source
+        self._nodes = None
+        # JSON node tree of a compiled module written with aliases, decoded instead of parsing the source
+        self._encoded_nodes = (aliases.fingerprint, encoded_nodes) if encoded_nodes is not None else None
+        self._calls = None
+        self._legacy_html = None
 
-def extract_components(mml_content):
+    def nodes(self, aliases=default_aliases):
+        nodes = self._nodes
+        if nodes is None or nodes[0] != aliases.fingerprint:
+            if self._encoded_nodes is not None and self._encoded_nodes[0] == aliases.fingerprint:
+                nodes = (aliases.fingerprint, tuple(decode_node(node) for node in self._encoded_nodes[1]))
+            else:
+                nodes = (aliases.fingerprint, tuple(parse_mml(self.source, aliases)))
+            self._nodes = nodes
+        return nodes[1]
+
+    def encoded_nodes(self, aliases=default_aliases):
+        if self._encoded_nodes is not None and self._encoded_nodes[0] == aliases.fingerprint:
+            return self._encoded_nodes[1]
+        return [encode_node(node) for node in self.nodes(aliases)]
+
+    @property
+    def calls(self):
+        """
+        Components called from the body, so call graphs can be walked without rendering.
+        """
+        if self._calls is None:
+            self._calls = frozenset(match.group(1) for match in component_call_pattern.finditer(self.source))
+        return self._calls
+
+    def legacy_html(self, aliases=default_aliases):
+        legacy_html = self._legacy_html
+        if legacy_html is None or legacy_html[0] != aliases.fingerprint:
+            legacy_html = self._legacy_html = (aliases.fingerprint, convert_component_to_html(self.source, aliases))
+        return legacy_html[1]
+
+# (@name) and (@name param.[value] other!"value") component calls
+component_call_pattern = re.compile(r'\(@([a-zA-Z_][a-zA-Z0-9_]*)((?:\s+[a-zA-Z][a-zA-Z0-9_-]*(?:\.\[[^\]]*\]|!"[^"]*"))*)\s*\)')
+# The same calls after the legacy passes turned their arguments into name="value"
+legacy_call_pattern = re.compile(r'\(@([a-zA-Z_][a-zA-Z0-9_]*)((?:\s+[a-zA-Z][a-zA-Z0-9_-]*="[^"]*")*)\s*\)')
+legacy_argument_pattern = re.compile(r'([a-zA-Z][a-zA-Z0-9_-]*)="([^"]*)"')
+
+# $export.name ... $/export declarations
+component_pattern = re.compile(r'\$export\.([a-zA-Z_][a-zA-Z0-9_]*)\s*(.*?)\$/export', re.DOTALL)
+
+def extract_components(ctx, mml_content):
     """
-    Extract components from the MML content and store them in the global components dictionary.
+    Extract components from the MML content and store them as templates in the components dictionary of the compile context.
     """
-    component_matches = re.findall(r'\$export\.([a-zA-Z_][a-zA-Z0-9_]*)\s*(.*?)\$/export', mml_content, re.DOTALL)
-    for component_name, component_body in component_matches:
-        components[component_name] = component_body.strip()
-    mml_content = re.sub(r'\$export\.([a-zA-Z_][a-zA-Z0-9_]*)\s*.*?\$/export', '', mml_content, flags=re.DOTALL)
-    return mml_content
+    def declare_component(match):
+        component_name, component_body = match.groups()
+        ctx.components[component_name] = ComponentTemplate(component_name, component_body.strip())
+        declare(ctx, "component", component_name)
+        return ''
+    return component_pattern.sub(declare_component, mml_content)
+
+# Passes of the legacy pipeline that turn MML elements into HTML, for pages and components alike
+legacy_open_pattern = re.compile(r'\(&([a-zA-Z0-9]+)((\s+[a-zA-Z]+(\.\[[^\]]+\]|\!"[^"]*"))*)\)')
+legacy_close_pattern = re.compile(r'\.\&([a-zA-Z0-9]+)')
+legacy_attribute_pattern = re.compile(r'([a-zA-Z][a-zA-Z0-9_-]*)\.\[([^\]]+)\]')
+legacy_quoted_attribute_pattern = re.compile(r'([a-zA-Z][a-zA-Z0-9_-]*)!"([^"]+)"')
+legacy_brace_pattern = re.compile(r'\{|\}')
+# Whole tag names only, custom elements included: <input stays <input, <text-editor is not taken for <text
+legacy_tag_pattern = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9-]*)')
+# In the order convert_component_to_html runs them
+legacy_component_patterns = (component_call_pattern, legacy_open_pattern, legacy_close_pattern, legacy_attribute_pattern,
+                             legacy_quoted_attribute_pattern, legacy_brace_pattern, legacy_tag_pattern)
+# Passes the legacy pipeline makes over a page before converting its elements
+legacy_document_passes = (
+    (re.compile(r'doc!.mml'), '<!DOCTYPE html>'),
+    (re.compile(r'!//'), '<!--'),
+    (re.compile(r'//!'), '-->'),
+)
+
+def legacy_attribute(aliases, match):
+    name = match.group(1)
+    return f'{aliases.attributes.get(name, name)}="{match.group(2)}"'
 
-def convert_component_to_html(component_body):
-    """
-    Convert a component's MML content to HTML.
-    """
-    component_body = re.sub(r'\(&([a-zA-Z0-9]+)((\s+[a-zA-Z]+(\.\[[^\]]+\]|\!"[^"]*"))*)\)', r'<\1\2>', component_body)
-    component_body = re.sub(r'\.\&([a-zA-Z0-9]+)', r'</\1>', component_body)
-    component_body = re.sub(r'cl\.\[([^\]]+)\]', r'class="\1"', component_body)
-    component_body = re.sub(r'link\.\[([^\]]+)\]', r'href="\1"', component_body)
-    component_body = re.sub(r'([a-zA-Z]+)\.\[([^\]]+)\]', r'\1="\2"', component_body)
-    component_body = re.sub(r'([a-zA-Z]+)!"([^"]+)"', r'\1="\2"', component_body)
-    component_body = re.sub(r'\{|\}', '', component_body)
-    component_body = re.sub(r'<mml', r'<html', component_body)
-    component_body = re.sub(r'<mml>', r'<html>', component_body)
-    component_body = re.sub(r'</mml>', r'</html>', component_body)
-    component_body = re.sub(r'<text', r'<p', component_body)
-    component_body = re.sub(r'<text>', r'<p>', component_body)
-    component_body = re.sub(r'</text>', r'</p>', component_body)
-    component_body = re.sub(r'<ct', r'<div', component_body)
-    component_body = re.sub(r'<ct>', r'<div>', component_body)
-    component_body = re.sub(r'</ct>', r'</div>', component_body)
-    component_body = re.sub(r'<js', r'<script', component_body)
-    component_body = re.sub(r'<js>', r'<script>', component_body)
-    component_body = re.sub(r'</js>', r'</script>', component_body)
-    component_body = re.sub(r'<btn', r'<button', component_body)
-    component_body = re.sub(r'<btn>', r'<button>', component_body)
-    component_body = re.sub(r'</btn>', r'</button>', component_body)
-    component_body = re.sub(r'<line', r'<hr', component_body)
-    component_body = re.sub(r'<line>', r'<hr>', component_body)
-    component_body = re.sub(r'<inct', r'<span', component_body)
-    component_body = re.sub(r'<inct>', r'<span>', component_body)
-    component_body = re.sub(r'</inct>', r'</span>', component_body)
-    component_body = re.sub(r'<in', r'<input', component_body)
-    component_body = re.sub(r'<in>', r'<input>', component_body)
-    component_body = re.sub(r'</in>', r'</input>', component_body)
-    return component_body
-
-def substitute_components(mml_content):
+def legacy_call(match):
+    arguments = ''.join(
+        f' {argument.group(1)}="{argument.group(2) if argument.group(2) is not None else argument.group(3)}"'
+        for argument in attribute_pattern.finditer(match.group(2))
+    )
+    return f'(@{match.group(1)}{arguments})'
+
+def legacy_tag(aliases, match):
+    tag = match.group(2)
+    return f'<{match.group(1)}{aliases.tags.get(tag, tag)}'
+
+def convert_component_to_html(component_body, aliases=default_aliases):
+    """
+    Convert a component's MML content to HTML. Tag names and attribute shorthands are
+    looked up in the tables of aliases, one pass for all of them.
+    """
+    # Call arguments are written as name="value" first, the attribute shorthands do not rename parameters
+    component_body = component_call_pattern.sub(legacy_call, component_body)
+    component_body = legacy_open_pattern.sub(r'<\1\2>', component_body)
+    component_body = legacy_close_pattern.sub(r'</\1>', component_body)
+    replace_attribute = partial(legacy_attribute, aliases)
+    component_body = legacy_attribute_pattern.sub(replace_attribute, component_body)
+    component_body = legacy_quoted_attribute_pattern.sub(replace_attribute, component_body)
+    component_body = legacy_brace_pattern.sub('', component_body)
+    return legacy_tag_pattern.sub(partial(legacy_tag, aliases), component_body)
+
+def bind_component_arguments(component_html, arguments):
+    """
+    Replace the :param: references of a component with its call arguments.
+    """
+    def replace(match):
+        if match.group(2) is None and match.group(1) in arguments:
+            return arguments[match.group(1)]
+        return match.group(0)
+    return reference_pattern.sub(replace, component_html)
+
+def substitute_components(ctx, mml_content):
     """
     Substitute components in the MML content with their HTML representation.
+    Calls are found in one scan, calls inside component bodies are expanded too.
+    Each distinct (component, arguments) call is expanded once per compile.
     """
-    for component_name, component_body in components.items():
-        component_html = convert_component_to_html(component_body)
-        mml_content = re.sub(rf'\(@{component_name}\)', component_html, mml_content)
-    return mml_content
+    expanding = []
+    guarded = []
+
+    def replace(match):
+        name = match.group(1)
+        template = ctx.components.get(name)
+        if template is None or name in expanding:
+            if template is not None:
+                guarded.append(name)
+            return match.group(0)
+        arguments = tuple(legacy_argument_pattern.findall(match.group(2)))
+        key = (name, arguments)
+        component_html = ctx.component_renders.get(key)
+        if ctx.timings is not None:
+            ctx.timings.count("component render misses" if component_html is None else "component render hits")
+        if component_html is not None:
+            return component_html
+        ctx.used_components.add(name)
+        start = len(guarded)
+        expanding.append(name)
+        component_html = bind_component_arguments(template.legacy_html(ctx.aliases), dict(arguments))
+        component_html = legacy_call_pattern.sub(replace, component_html)
+        expanding.pop()
+        # Recursive components expand differently depending on where they are called, so only acyclic expansions are reused
+        if len(guarded) == start:
+            ctx.component_renders[key] = component_html
+        return component_html
+
+    return legacy_call_pattern.sub(replace, mml_content)
+
+# Single-pass tokenizer, parser and emitter
+
+# Every MML token the converter understands, matched in one scan over the document.
+# Each alternative starts with a literal character, so the regex engine only tries
+# them at those characters and skips everything in between. Braces directly after an
+# open tag or before a close tag are part of that token, empty groups tell the other
+# tokens apart (match.lastgroup).
+token_pattern = re.compile(
+    r'\(&(?P<open>[a-zA-Z0-9]+)(?P<attributes>(?:\s+[a-zA-Z][a-zA-Z0-9_-]*(?:\.\[[^\]]*\]|!"[^"]*"))*)\s*\)\{?'
+    r'|\.&(?P<close>[a-zA-Z0-9]+)'
+    r'|\}(?:\.&(?P<brace_close>[a-zA-Z0-9]+)|(?P<close_brace>))'
+    r'|:(?P<ref>[a-zA-Z_][a-zA-Z0-9_]*)(?:\.(?P<key>[a-zA-Z_][a-zA-Z0-9_]*))?:(?!type)'
+    r'|\(@(?P<call>[a-zA-Z_][a-zA-Z0-9_]*)(?P<call_arguments>(?:\s+[a-zA-Z][a-zA-Z0-9_-]*(?:\.\[[^\]]*\]|!"[^"]*"))*)\s*\)'
+    r'|<(?P<html_slash>/?)(?P<html_tag>[a-zA-Z][a-zA-Z0-9-]*)'
+    r'|!//(?:(?P<comment>.*?)//!|(?P<comment_open>))'
+    r'|//!(?P<comment_close>)'
+    r'|doc!\.mml(?P<doctype>)'
+    r'|\{(?P<open_brace>)',
+    re.DOTALL,
+)
+attribute_pattern = re.compile(r'([a-zA-Z][a-zA-Z0-9_-]*)(?:\.\[([^\]]*)\]|!"([^"]*)")')
+reference_pattern = re.compile(r':([a-zA-Z_][a-zA-Z0-9_]*)(?:\.([a-zA-Z_][a-zA-Z0-9_]*))?:(?!type)')
+
+# Text is kept as plain str nodes, which are cheaper to create and to render than objects
+
+class Comment:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+class Element:
+    """
+    An MML element. Attribute values are tuples of str and VariableRef nodes.
+    """
+    __slots__ = ("tag", "attributes", "children", "closed")
+
+    def __init__(self, tag, attributes=()):
+        self.tag = tag
+        self.attributes = attributes
+        self.children = []
+        self.closed = False
+
+class CloseTag:
+    """
+    A closing tag without a matching open element.
+    """
+    __slots__ = ("tag",)
+
+    def __init__(self, tag):
+        self.tag = tag
+
+class ComponentCall:
+    """
+    A (@name) component call. Argument values are tuples of str and VariableRef
+    nodes, source is the call as written.
+    """
+    __slots__ = ("name", "arguments", "source")
+
+    def __init__(self, name, arguments=(), source=None):
+        self.name = name
+        self.arguments = arguments
+        self.source = source if source is not None else f'(@{name})'
 
-def convert_mml_to_html(mml_content):
+class VariableRef:
+    """
+    A :name: variable reference, or a :name.key: hashmap reference when key is set.
+    """
+    __slots__ = ("name", "key")
+
+    def __init__(self, name, key=None):
+        self.name = name
+        self.key = key
+
+def parse_text_parts(value):
+    """
+    Split a text value into a tuple of str and VariableRef nodes.
+    """
+    if ':' not in value:
+        return (value,)
+    parts = []
+    position = 0
+    for match in reference_pattern.finditer(value):
+        if match.start() > position:
+            parts.append(value[position:match.start()])
+        parts.append(VariableRef(match.group(1), match.group(2)))
+        position = match.end()
+    if position < len(value):
+        parts.append(value[position:])
+    return tuple(parts)
+
+# Pages repeat the same attributes over and over (cl.[card], type.[text]), their parsed
+# form is never modified and can be shared
+@lru_cache(maxsize=4096)
+def parse_attributes(attribute_source, aliases=default_aliases):
+    names = aliases.attributes
+    return tuple((names.get(name, name), parse_text_parts(value if value else old_value))
+                 for name, value, old_value in attribute_pattern.findall(attribute_source))
+
+def token_node(match, aliases=default_aliases):
+    """
+    The node of a token_pattern match, or None for tokens that produce no output.
+    Tag and attribute names are converted with aliases.
+    """
+    kind = match.lastgroup
+    if kind == 'attributes':
+        tag = match.group('open')
+        return Element(aliases.tags.get(tag, tag), parse_attributes(match.group('attributes'), aliases))
+    if kind == 'close' or kind == 'brace_close':
+        tag = match.group(kind)
+        return CloseTag(aliases.tags.get(tag, tag))
+    if kind == 'ref' or kind == 'key':
+        return VariableRef(match.group('ref'), match.group('key'))
+    if kind == 'html_tag':
+        tag = match.group('html_tag')
+        return f"<{match.group('html_slash')}{aliases.tags.get(tag, tag)}"
+    if kind == 'call_arguments':
+        arguments = tuple((name, parse_text_parts(value if value else old_value))
+                          for name, value, old_value in attribute_pattern.findall(match.group('call_arguments')))
+        return ComponentCall(match.group('call'), arguments, match.group(0))
+    if kind == 'comment':
+        return Comment(match.group('comment'))
+    if kind == 'doctype':
+        return '<!DOCTYPE html>'
+    if kind == 'comment_open':
+        return '<!--'
+    if kind == 'comment_close':
+        return '-->'
+    # Braces only delimit element content and produce no output
+    return None
+
+def close_void(stack):
+    """
+    Close the innermost open element as a void element, its children follow it.
+    """
+    element = stack.pop()
+    stack[-1].children.extend(element.children)
+    element.children = []
+
+def parse_mml(mml_content, aliases=default_aliases):
+    """
+    Build a node tree from MML content in a single pass. Elements without a
+    matching close tag (e.g. (&meta) or (&in)) are kept as void elements.
+    """
+    tags = aliases.tags
+    root = Element(None)
+    stack = [root]
+    append = root.children.append
+    position = 0
+    for match in token_pattern.finditer(mml_content):
+        start, end = match.span()
+        if start > position:
+            append(mml_content[position:start])
+        position = end
+        # The most frequent tokens are handled here instead of in token_node
+        kind = match.lastgroup
+        if kind == 'attributes':
+            tag = match.group('open')
+            element = Element(tags.get(tag, tag), parse_attributes(match.group('attributes'), aliases))
+            append(element)
+            stack.append(element)
+            append = element.children.append
+        elif kind == 'close' or kind == 'brace_close':
+            tag = match.group(kind)
+            tag = tags.get(tag, tag)
+            depth = len(stack) - 1
+            while depth > 0 and stack[depth].tag != tag:
+                depth -= 1
+            if depth == 0:
+                append(CloseTag(tag))
+                continue
+            while len(stack) - 1 > depth:
+                close_void(stack)
+            stack.pop().closed = True
+            append = stack[-1].children.append
+        elif kind == 'ref':
+            append(VariableRef(match.group('ref')))
+        else:
+            node = token_node(match, aliases)
+            if node is not None:
+                append(node)
+
+    if position < len(mml_content):
+        append(mml_content[position:])
+    while len(stack) > 1:
+        close_void(stack)
+    return root.children
+
+def resolve_reference(ctx, name, key=None):
+    """
+    Look up a variable or hashmap reference. Unknown references are kept as written.
+    """
+    value = lookup_reference(ctx, name, key)
+    if value is None:
+        value = f':{name}.{key}:' if key else f':{name}:'
+        ctx.unresolved_references.add(value)
+    elif key is None:
+        ctx.used_variables.add(name)
+    else:
+        ctx.used_hashmaps.add(name)
+    return value
+
+def resolve_part(ctx, part, arguments=None):
+    if type(part) is str:
+        return part
+    if arguments and part.key is None and part.name in arguments:
+        return arguments[part.name]
+    return resolve_reference(ctx, part.name, part.key)
+
+def render_parts(ctx, parts, arguments=None):
+    if len(parts) == 1 and type(parts[0]) is str:
+        return parts[0]
+    return ''.join([resolve_part(ctx, part, arguments) for part in parts])
+
+def render_open_tag(ctx, element, arguments=None):
+    if not element.attributes:
+        return f'<{element.tag}>'
+    attributes = ' '.join([f'{name}="{render_parts(ctx, parts, arguments)}"' for name, parts in element.attributes])
+    return f'<{element.tag} {attributes}>'
+
+def render_nodes(ctx, nodes, out, arguments=None, expanding=frozenset(), guarded=None):
+    """
+    Walk a node tree and append its HTML fragments to the list out, in document order.
+    Component calls are expanded in place, including nested calls.
+    Inside a component body, arguments maps its parameters to their values.
+    """
+    if guarded is None:
+        guarded = []
+    append = out.append
+    # (children still to render, close tag of their element or None)
+    pending = [(iter(nodes), None)]
+    while pending:
+        children, close_tag = pending[-1]
+        for node in children:
+            node_type = type(node)
+            if node_type is str:
+                append(node)
+            elif node_type is Element:
+                append(render_open_tag(ctx, node, arguments))
+                pending.append((iter(node.children), f'</{node.tag}>' if node.closed else None))
+                break
+            elif node_type is VariableRef:
+                append(resolve_part(ctx, node, arguments))
+            elif node_type is CloseTag:
+                append(f'</{node.tag}>')
+            elif node_type is Comment:
+                append(f'<!--{node.value}-->')
+            elif node_type is ComponentCall:
+                template = ctx.components.get(node.name)
+                if template is None or node.name in expanding:
+                    if template is not None:
+                        guarded.append(node.name)
+                    append(node.source)
+                else:
+                    values = tuple((name, render_parts(ctx, parts, arguments)) for name, parts in node.arguments)
+                    append(render_component(ctx, template, values, expanding, guarded))
+        else:
+            pending.pop()
+            if close_tag is not None:
+                append(close_tag)
+    return out
+
+def render_component(ctx, template, arguments=(), expanding=frozenset(), guarded=None):
+    """
+    Render a component called with a tuple of (parameter, value) arguments.
+    Renders are memoized per (component, arguments) for the rest of the compile.
+    """
+    key = (template.name, arguments)
+    component_html = ctx.component_renders.get(key)
+    if ctx.timings is not None:
+        ctx.timings.count("component render misses" if component_html is None else "component render hits")
+    if component_html is not None:
+        return component_html
+    if guarded is None:
+        guarded = []
+    ctx.used_components.add(template.name)
+    start = len(guarded)
+    component_html = ''.join(render_nodes(ctx, template.nodes(ctx.aliases), [], dict(arguments), expanding | {template.name}, guarded))
+    # Recursive components render differently depending on where they are called, so only acyclic renders are reused
+    if len(guarded) == start:
+        ctx.component_renders[key] = component_html
+    return component_html
+
+def render_html(ctx, nodes):
+    """
+    Emit HTML for a node tree.
+    """
+    return ''.join(render_nodes(ctx, nodes, []))
+
+def convert_syntax_legacy(ctx, mml_content):
+    """
+    Convert MML syntax to HTML with the original sequential regex passes.
+    Kept behind the legacy flag so output can be diffed against the tokenizer.
+    """
+    mml_content = run_stage(ctx, "legacy tags", convert_tags_legacy, mml_content)
+    mml_content = run_stage(ctx, "legacy components", substitute_components, mml_content)
+    return run_stage(ctx, "output references", substitute_output_references, mml_content)
+
+def convert_tags_legacy(ctx, mml_content):
+    for pattern, replacement in legacy_document_passes:
+        mml_content = pattern.sub(replacement, mml_content)
+    return convert_component_to_html(mml_content, ctx.aliases)
+
+# Declaration stages of a compile, in order. Each one runs over the whole document before the next.
+pipeline_stages = (
+    ("includes", extract_includes),
+    ("variables", extract_variables),
+    ("variable functions", substitute_variable_functions),
+    ("assignments", assign_variables),
+    ("hashmaps", extract_hashmaps),
+    ("components", extract_components),
+)
+
+def convert_mml_to_html(mml_content, legacy=False, ctx=None):
     """
     Convert MML content to HTML.
+    Set legacy to use the original regex pipeline instead of the tokenizer.
+    A fresh CompileContext is used unless one is passed in.
     """
-    variables.update(shared_variables)
-    mml_content = extract_includes(mml_content)
-    mml_content = extract_variables(mml_content)
-    mml_content = substitute_variable_functions(mml_content)
-    mml_content = assign_variables(mml_content)
-    mml_content = extract_hashmaps(mml_content)
-    mml_content = extract_components(mml_content)
-    mml_content = re.sub(r'doc!.mml', r'<!DOCTYPE html>', mml_content)
-    mml_content = re.sub(r'!//', r'<!--', mml_content)
-    mml_content = re.sub(r'//!', r'-->', mml_content)
-    mml_content = re.sub(r'\(&([a-zA-Z0-9]+)((\s+[a-zA-Z]+(\.\[[^\]]+\]|\!"[^"]*"))*)\)', r'<\1\2>', mml_content)
-    mml_content = re.sub(r'\.\&([a-zA-Z0-9]+)', r'</\1>', mml_content)
-    mml_content = re.sub(r'cl\.\[([^\]]+)\]', r'class="\1"', mml_content)
-    mml_content = re.sub(r'link\.\[([^\]]+)\]', r'href="\1"', mml_content)
-    mml_content = re.sub(r'([a-zA-Z]+)\.\[([^\]]+)\]', r'\1="\2"', mml_content)
-    mml_content = re.sub(r'([a-zA-Z]+)!"([^"]+)"', r'\1="\2"', mml_content)
-    mml_content = re.sub(r'\{|\}', '', mml_content)
-    mml_content = re.sub(r'<mml', r'<html', mml_content)
-    mml_content = re.sub(r'<mml>', r'<html>', mml_content)
-    mml_content = re.sub(r'</mml>', r'</html>', mml_content)
-    mml_content = re.sub(r'<text', r'<p', mml_content)
-    mml_content = re.sub(r'<text>', r'<p>', mml_content)
-    mml_content = re.sub(r'</text>', r'</p>', mml_content)
-    mml_content = re.sub(r'<ct', r'<div', mml_content)
-    mml_content = re.sub(r'<ct>', r'<div>', mml_content)
-    mml_content = re.sub(r'</ct>', r'</div>', mml_content)
-    mml_content = re.sub(r'<js', r'<script', mml_content)
-    mml_content = re.sub(r'<js>', r'<script>', mml_content)
-    mml_content = re.sub(r'</js>', r'</script>', mml_content)
-    mml_content = re.sub(r'<btn', r'<button', mml_content)
-    mml_content = re.sub(r'<btn>', r'<button>', mml_content)
-    mml_content = re.sub(r'</btn>', r'</button>', mml_content)
-    mml_content = re.sub(r'<line', r'<hr', mml_content)
-    mml_content = re.sub(r'<line>', r'<hr>', mml_content)
-    mml_content = re.sub(r'<inct', r'<span', mml_content)
-    mml_content = re.sub(r'<inct>', r'<span>', mml_content)
-    mml_content = re.sub(r'</inct>', r'</span>', mml_content)
-    mml_content = re.sub(r'<in', r'<input', mml_content)
-    mml_content = re.sub(r'<in>', r'<input>', mml_content)
-    mml_content = re.sub(r'</in>', r'</input>', mml_content)
-    mml_content = substitute_components(mml_content)
-    mml_content = substitute_hashmaps(mml_content)
-    mml_content = substitute_variables(mml_content)
-    return mml_content
+    if ctx is None:
+        ctx = CompileContext()
+    ctx.unresolved_references.clear()
+    ctx.variables.update(ctx.shared_variables)
+    ctx.volatile = ctx.volatile or bool(volatile_declaration_pattern.search(mml_content))
+    for name, stage in pipeline_stages:
+        mml_content = run_stage(ctx, name, stage, mml_content)
+    if legacy:
+        return convert_syntax_legacy(ctx, mml_content)
+    nodes = run_stage(ctx, "parse", lambda ctx, mml_content: parse_mml(mml_content, ctx.aliases), mml_content)
+    return run_stage(ctx, "render", render_html, nodes)
+
+# Streaming compile
+
+# Characters read from the input at a time
+stream_chunk_size = 1 << 20
+# Text held back at the end of each chunk, so no token is cut in two (a longer token is always read to its end)
+stream_lookahead = 1 << 16
+# Intermediate copies of the document stay in memory up to this size and go to a temporary file beyond it
+stream_spool_size = 8 << 20
+
+blank_lines_pattern = re.compile(r'\n\s*\n')
+map_start_pattern = re.compile(r'map\.[a-zA-Z_][a-zA-Z0-9_]*\s*(?:\{|\Z)')
+component_start_pattern = re.compile(r'\$export\.')
+# An element or component call that is still open at the end of the text
+pending_tag_pattern = re.compile(
+    r'\((?:(?:&[a-zA-Z0-9]*|@(?:[a-zA-Z_][a-zA-Z0-9_]*)?)'
+    r'(?:\s+[a-zA-Z][a-zA-Z0-9_-]*(?:\.\[[^\]]*\]|!"[^"]*"))*'
+    r'(?:\s+(?:[a-zA-Z][a-zA-Z0-9_-]*(?:\.(?:\[[^\]]*)?|!(?:"[^"]*)?)?)?)?)?\Z'
+)
+# The start of any other token, which contains no whitespace, cut off by the end of the text
+pending_word_pattern = re.compile(
+    r'\}\.(?:&[a-zA-Z0-9]*)?\Z|\.(?:&[a-zA-Z0-9]*)?\Z'
+    r'|:(?:[a-zA-Z_][a-zA-Z0-9_]*(?:\.(?:[a-zA-Z_][a-zA-Z0-9_]*)?)?(?::(?:t(?:y(?:p)?)?)?)?)?\Z'
+    r'|<(?:/?[a-zA-Z][a-zA-Z0-9-]*|/)?\Z'
+    r'|!(?:/(?:/)?)?\Z|/(?:/)?\Z'
+    r'|d(?:o(?:c(?:!(?:\.(?:m(?:m(?:l)?)?)?)?)?)?)?\Z'
+)
+
+def line_tail(segment):
+    """
+    Start of the incomplete last line of a segment, which is carried over to the next one.
+    """
+    return segment.rfind('\n') + 1
 
-def compile_mml_to_html(input_file, output_file):
+def block_tail(segment, start_pattern, end_marker):
     """
-    Compile an MML file to an HTML file.
+    Start of a block that is still open at the end of a segment, or of its last line.
     """
-    with open(input_file, "r") as mml_file:
-        mml_content = mml_file.read()
-    html_content = convert_mml_to_html(mml_content)
-    html_content = re.sub(r'\n\s*\n', r'\n', html_content)
-    with open(output_file, "w") as html_file:
-        html_file.write(html_content)
+    tail = line_tail(segment)
+    end = segment.rfind(end_marker, 0, tail)
+    match = start_pattern.search(segment, end + len(end_marker) if end != -1 else 0, tail)
+    return match.start() if match else tail
+
+# Where each declaration stage may split the document, so no declaration is cut in two
+stage_tails = {
+    "hashmaps": lambda segment: block_tail(segment, map_start_pattern, '}'),
+    "components": lambda segment: block_tail(segment, component_start_pattern, '$/export'),
+}
+
+def read_chunks(source, chunk_size=stream_chunk_size):
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def stream_stage(ctx, name, function, chunks):
+    """
+    Run a declaration stage over a document given as chunks, one segment at a time.
+    """
+    tail = stage_tails.get(name, line_tail)
+    carry = ''
+    for chunk in chunks:
+        segment = carry + chunk
+        cut = tail(segment)
+        carry = segment[cut:]
+        if cut:
+            yield run_stage(ctx, name, function, segment[:cut])
+    if carry:
+        yield run_stage(ctx, name, function, carry)
+
+def spool(fragments):
+    spooled = tempfile.SpooledTemporaryFile(max_size=stream_spool_size, mode='w+', encoding='utf-8', newline='')
+    for fragment in fragments:
+        spooled.write(fragment)
+    spooled.seek(0)
+    return spooled
+
+def pending_tag(buffer, start, end):
+    """
+    Start of an element or component call between start and end that may continue after
+    the end of buffer, or end if there is none.
+    """
+    start = buffer.find('(', start, end)
+    while start != -1:
+        if pending_tag_pattern.match(buffer, start):
+            return start
+        start = buffer.find('(', start + 1, end)
+    return end
+
+def tokenize_mml_stream(chunks, lookahead=None, aliases=default_aliases):
+    """
+    Split MML given as chunks into a flat stream of nodes (see token_node). Only lookahead
+    characters beyond the current token are kept in memory, a longer token (usually a
+    comment or a tag with long attribute values) is read to its end first.
+    """
+    if lookahead is None:
+        lookahead = stream_lookahead
+    buffer = ''
+    chunks = iter(chunks)
+    at_end = False
+    while not at_end:
+        chunk = next(chunks, None)
+        if chunk is None:
+            at_end = True
+        else:
+            buffer += chunk
+            if len(buffer) <= lookahead:
+                continue
+        cutoff = len(buffer) if at_end else len(buffer) - lookahead
+        if not at_end:
+            # Only tags contain whitespace, those are looked for in the text between tokens below
+            word = max(buffer.rfind(' '), buffer.rfind('\n'), buffer.rfind('\t')) + 1
+            pending = pending_word_pattern.search(buffer, word)
+            if pending is not None:
+                cutoff = min(cutoff, pending.start())
+        position = 0
+        stop = cutoff
+        for match in token_pattern.finditer(buffer):
+            if not at_end:
+                # Tokens near the end may continue in the next chunk, an opening !// may be a comment that does
+                if match.end() > cutoff or match.end() == len(buffer) or match.lastgroup == 'comment_open':
+                    stop = min(match.start(), cutoff)
+                    break
+                # An incomplete tag is not matched, the text before the next token may hold its start
+                if match.start() > position and pending_tag(buffer, position, match.start()) < match.start():
+                    stop = match.start()
+                    break
+            if match.start() > position:
+                yield buffer[position:match.start()]
+            position = match.end()
+            node = token_node(match, aliases)
+            if node is not None:
+                yield node
+        if not at_end and stop > position:
+            stop = pending_tag(buffer, position, stop)
+        stop = max(stop, position)
+        if stop > position:
+            yield buffer[position:stop]
+        buffer = buffer[stop:]
+
+def iter_html_stream(ctx, nodes):
+    """
+    Emit HTML for a flat stream of nodes. Only the names of the open elements are
+    kept: an element without a close tag renders the same as a void element.
+    """
+    open_tags = []
+    for node in nodes:
+        if isinstance(node, Element):
+            open_tags.append(node.tag)
+            yield render_open_tag(ctx, node)
+        elif isinstance(node, CloseTag):
+            for depth in range(len(open_tags) - 1, -1, -1):
+                if open_tags[depth] == node.tag:
+                    del open_tags[depth:]
+                    break
+            yield f'</{node.tag}>'
+        else:
+            yield from render_nodes(ctx, (node,), [])
+
+def collapse_blank_lines(fragments, batch_size=1 << 16):
+    """
+    Apply the blank line cleanup of compile_string to a stream of fragments, in batches.
+    A run of whitespace is never split between batches.
+    """
+    parts = []
+    size = 0
+    for fragment in fragments:
+        parts.append(fragment)
+        size += len(fragment)
+        if size >= batch_size:
+            text = ''.join(parts)
+            keep = len(text.rstrip())
+            if keep:
+                yield blank_lines_pattern.sub('\n', text[:keep])
+            parts = [text[keep:]]
+            size = len(parts[0])
+    text = ''.join(parts)
+    if text:
+        yield blank_lines_pattern.sub('\n', text)
+
+def stream_mml_to_html(source, ctx=None, chunk_size=stream_chunk_size):
+    """
+    Convert MML read from a text file object to HTML, yielding fragments as they are produced.
+    Declarations may appear anywhere, so every declaration stage first passes over the whole
+    document, writing its output to a spooled temporary file. The HTML is then emitted in a
+    last pass. Memory is bounded by the chunk size, nesting depth and symbol tables.
+    """
+    if ctx is None:
+        ctx = CompileContext()
+    ctx.unresolved_references.clear()
+    ctx.variables.update(ctx.shared_variables)
+    current = source
+    try:
+        for name, function in pipeline_stages:
+            spooled = spool(stream_stage(ctx, name, function, read_chunks(current, chunk_size)))
+            if current is not source:
+                current.close()
+            current = spooled
+        nodes = tokenize_mml_stream(read_chunks(current, chunk_size), aliases=ctx.aliases)
+        yield from collapse_blank_lines(iter_html_stream(ctx, nodes))
+    finally:
+        if current is not source:
+            current.close()
+
+# Production output
+
+# One scan over the HTML: blocks whose whitespace matters, comments (except IE conditional
+# comments), tags (attribute values are kept as written, a > in a quoted value does not
+# end the tag) and runs of whitespace in text
+minify_pattern = re.compile(
+    r'(?P<raw><(?P<raw_tag>pre|script|style|textarea)\b[^>]*>.*?</(?P=raw_tag)\s*>)'
+    r'|(?P<comment>\s*<!--(?!\[if).*?-->\s*)'
+    r'|(?P<tag></?[a-zA-Z!?][^\'">]*(?:(?:"[^"]*"|\'[^\']*\')[^\'">]*)*>)'
+    r'|(?P<space>\s+)',
+    re.DOTALL | re.IGNORECASE,
+)
+
+def minify_html(html_content):
+    """
+    Collapse whitespace in text to a single space and strip comments, leaving
+    <pre>, <script>, <style> and <textarea> blocks and tags untouched.
+    """
+    def replace(match):
+        kind = match.lastgroup
+        if kind == 'space':
+            return ' '
+        if kind == 'comment':
+            # The comment goes, the whitespace around it still separates the words
+            text = match.group(0)
+            return ' ' if text[0].isspace() or text[-1].isspace() else ''
+        return match.group(0)
+    return minify_pattern.sub(replace, html_content).strip()
+
+def load_brotli():
+    """
+    The brotli module, or None if it is not installed. Imported on first use, so
+    compiles that don't compress don't pay for it.
+    """
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+def precompress(output_file, previous=None):
+    """
+    Write output_file.gz, and output_file.br when brotli is installed, next to a compiled page.
+    Returns the content record of the page: its sha256, size and compressed sizes. If previous
+    (the record of the last build) has the same hash and the compressed files still exist,
+    they are kept as they are, so unchanged pages are not compressed or uploaded again.
+    """
+    with open(output_file, 'rb') as f:
+        data = f.read()
+    record = {"sha256": hashlib.sha256(data).hexdigest(), "size": len(data)}
+    brotli = load_brotli()
+    outputs = {"gzip": output_file + '.gz'}
+    if brotli is not None:
+        outputs["br"] = output_file + '.br'
+    elif os.path.exists(output_file + '.br'):
+        # Left by a build that had brotli, it no longer matches the page
+        os.remove(output_file + '.br')
+
+    if (previous is not None and previous.get("sha256") == record["sha256"]
+            and all(name in previous and os.path.exists(path) for name, path in outputs.items())):
+        record.update((name, previous[name]) for name in outputs)
+        return record
+    import gzip
+    # mtime=0 keeps the gzip output the same for the same page
+    compressed = gzip.compress(data, 9, mtime=0)
+    write_bytes(outputs["gzip"], compressed)
+    record["gzip"] = len(compressed)
+    if brotli is not None:
+        compressed = brotli.compress(data, quality=11)
+        write_bytes(outputs["br"], compressed)
+        record["br"] = len(compressed)
+    return record
+
+# Regex scans over the whole document made by each stage (see CompileTimings), one entry
+# per scan. Scans of single declarations (e.g. the references in one variable value) are
+# not counted.
+stage_patterns = {
+    "includes": (include_source_pattern, native_include_pattern, include_pattern),
+    "variables": (static_variable_pattern, dynamic_variable_pattern, dynamic_variable_pattern),
+    "variable functions": (substitution_pattern,),
+    "assignments": (assignment_pattern,),
+    "hashmaps": (hashmap_pattern,),
+    "components": (component_pattern,),
+    "parse": (token_pattern,),
+    "render": (),
+    "legacy tags": tuple(pattern for pattern, _ in legacy_document_passes) + legacy_component_patterns,
+    "legacy components": (legacy_call_pattern,),
+    "output references": (substitution_pattern,),
+    "cleanup": (blank_lines_pattern,),
+    "minify": (minify_pattern,),
+}
+
+class Compiler:
+    """
+    Reentrant MML compiler. Every compile gets its own CompileContext,
+    so one Compiler can be shared by many pages and threads.
+    """
+
+    def __init__(self, legacy=False, include_cache=None, remote_cache=None, timings=False, timings_hook=None, optimize=False,
+                 aliases=None, write_modules=None):
+        self.legacy = legacy
+        # Each include is parsed once and reused for every page compiled by this Compiler
+        self.include_cache = include_cache if include_cache is not None else IncludeCache()
+        self.remote_cache = remote_cache if remote_cache is not None else RemoteCache()
+        # With timings (or a hook), every compile records a CompileTimings in ctx.timings.
+        # timings_hook(timings) is called after every compile, e.g. to feed a dashboard.
+        self.timings = timings or timings_hook is not None
+        self.timings_hook = timings_hook
+        # With optimize, the HTML is minified and comments are stripped (see precompress for the compressed copies)
+        self.optimize = optimize
+        # Aliases of the tags and attributes of every page, e.g. load_project_config("mml.json")
+        self.aliases = aliases if aliases is not None else default_aliases
+        # Whether compiled .mmlc modules of includes are written, MML_DONT_WRITE_MMLC decides by default
+        self.write_modules = write_modules if write_modules is not None else module_writes_enabled()
+
+    def new_context(self, base_dir=None):
+        return CompileContext(self.include_cache, base_dir, self.remote_cache, timings=CompileTimings() if self.timings else None,
+                              aliases=self.aliases, write_modules=self.write_modules)
+
+    def compile_string(self, mml_content, ctx=None):
+        """
+        Compile MML source to HTML. Pass a CompileContext to inspect the symbol
+        tables, errors and unresolved references afterwards.
+        """
+        if ctx is None:
+            ctx = self.new_context()
+        html_content = convert_mml_to_html(mml_content, self.legacy, ctx)
+        html_content = run_stage(ctx, "cleanup", lambda ctx, html_content: blank_lines_pattern.sub('\n', html_content), html_content)
+        if self.optimize:
+            html_content = run_stage(ctx, "minify", lambda ctx, html_content: minify_html(html_content), html_content)
+        if self.timings_hook is not None and ctx.timings is not None:
+            self.timings_hook(ctx.timings)
+        return html_content
+
+    def compile_stream(self, source, ctx=None):
+        """
+        Compile MML read from a text file object, yielding HTML fragments as they are
+        produced, e.g. to write them to a file or socket. Memory does not grow with the
+        size of the document. Not available with the legacy pipeline.
+        """
+        if self.legacy:
+            raise ValueError("streaming is not supported by the legacy pipeline")
+        if self.optimize:
+            raise ValueError("streamed output cannot be optimized")
+        if ctx is None:
+            ctx = self.new_context()
+
+        def fragments():
+            yield from stream_mml_to_html(source, ctx)
+            if self.timings_hook is not None and ctx.timings is not None:
+                self.timings_hook(ctx.timings)
+        return fragments()
+
+    def compile_file(self, input_file, output_file=None, ctx=None, stream=False):
+        """
+        Compile an MML file to an HTML file. The output defaults to the input path with a .html suffix.
+        Relative includes are resolved against the directory of input_file first.
+        With stream, the file is compiled with compile_stream instead of being read into memory.
+        Returns the path of the written file.
+        """
+        if output_file is None:
+            output_file = os.path.splitext(input_file)[0] + ".html"
+        if ctx is None:
+            ctx = self.new_context()
+        ctx.base_dir = os.path.dirname(os.path.abspath(input_file))
+        ctx.include_stack = (os.path.abspath(input_file),)
+        if stream:
+            with open(input_file, "r") as mml_file, open(output_file, "w") as html_file:
+                for fragment in self.compile_stream(mml_file, ctx):
+                    html_file.write(fragment)
+            return output_file
+        with open(input_file, "r") as mml_file:
+            mml_content = mml_file.read()
+        html_content = self.compile_string(mml_content, ctx)
+        with open(output_file, "w") as html_file:
+            html_file.write(html_content)
+        return output_file
+
+def compile_messages(ctx):
+    """
+    Errors and warnings reported by a compile, in the order they should be shown.
+    """
+    messages = list(ctx.errors)
+    messages.extend(f"Warning: unresolved reference {reference}" for reference in sorted(ctx.unresolved_references))
+    return messages
+
+def declaration_usage(ctx):
+    """
+    Every declaration of a compile as (origin, kind, name) -> whether it is used: by the
+    output, by a component the output renders (transitively) or by another declared value.
+    """
+    used = {
+        "component": ctx.used_components,
+        "variable": ctx.used_variables | ctx.declaration_references,
+        "hashmap": ctx.used_hashmaps | ctx.declaration_references,
+    }
+    return {(origin, kind, name): name in used[kind] for (kind, name), origin in ctx.declarations.items()}
+
+def unused_declarations(usages):
+    """
+    The (origin, kind, name) of the declarations no compile used, from the declaration_usage()
+    of one or more compiles. A declaration shared by several pages is unused only if none of them uses it.
+    """
+    used = {}
+    for usage in usages:
+        for declaration, is_used in usage.items():
+            used[declaration] = used.get(declaration, False) or is_used
+    return sorted(declaration for declaration, is_used in used.items() if not is_used)
+
+def format_unused(unused):
+    if not unused:
+        return "No unused declarations"
+    lines = [f"Unused declarations ({len(unused)}):"]
+    current_origin = None
+    for origin, kind, name in unused:
+        if origin != current_origin:
+            current_origin = origin
+            if not origin:
+                lines.append("  (page)")
+            elif os.path.isabs(origin):
+                lines.append(f"  {os.path.relpath(origin)}")
+            else:
+                lines.append(f"  {origin}")
+        lines.append(f"    {kind} {name}")
+    return '\n'.join(lines)
+
+def compile_mml_to_html(input_file, output_file, legacy=False, remote_cache=None, timings=False, stream=False, optimize=False,
+                        aliases=None, write_modules=None):
+    """
+    Compile an MML file to an HTML file. With optimize, the HTML is minified and
+    precompressed copies are written next to it. Returns the CompileContext of the compile.
+    """
+    compiler = Compiler(legacy, remote_cache=remote_cache, timings=timings, optimize=optimize, aliases=aliases,
+                        write_modules=write_modules)
+    ctx = compiler.new_context()
+    output_file = compiler.compile_file(input_file, output_file, ctx, stream)
+    if optimize:
+        precompress(output_file)
+    for message in compile_messages(ctx):
+        print(f"{message} ({input_file})")
+    return ctx
+
+# Batch builds
+
+def find_pages(src_dir):
+    """
+    Find the pages below src_dir: every .mml file that is not pulled in by an
+    !include of another file in the tree.
+    """
+    mml_files = []
+    for root, _, files in os.walk(src_dir):
+        for file in files:
+            if file.endswith('.mml'):
+                mml_files.append(os.path.abspath(os.path.join(root, file)))
+
+    included = set()
+    included_dirs = []
+    for mml_file in mml_files:
+        with open(mml_file, 'r') as f:
+            content = f.read()
+        for path in include_pattern.findall(content):
+            if path.startswith(('http://', 'https://')):
+                continue
+            ctx = CompileContext(base_dir=os.path.dirname(mml_file))
+            resolved_path = os.path.abspath(resolve_include_path(ctx, path))
+            if os.path.isdir(resolved_path):
+                included_dirs.append(resolved_path + os.sep)
+            else:
+                included.add(resolved_path)
+
+    return sorted(
+        mml_file for mml_file in mml_files
+        if mml_file not in included and not mml_file.startswith(tuple(included_dirs))
+    )
+
+# Name of the build manifest (dependency graph and input hashes) written to the output folder
+manifest_name = '.mml-manifest.json'
+
+class DependencyHasher:
+    """
+    Content hashes of page inputs. Local files are memoized by modification time and size,
+    so every shared include is hashed once per build.
+    """
+
+    def __init__(self, remote_cache, include_cache):
+        self.remote_cache = remote_cache
+        self.include_cache = include_cache
+        self.file_hashes = {}
+
+    def hash(self, dependency):
+        """
+        Hash of a "kind:target" dependency, or None if it cannot be read.
+        """
+        kind, target = dependency.split(':', 1)
+        try:
+            if kind == 'file':
+                stat = os.stat(target)
+                key = (target, stat.st_mtime_ns, stat.st_size)
+                digest = self.file_hashes.get(key)
+                if digest is None:
+                    with open(target, 'rb') as f:
+                        digest = hashlib.sha256(f.read()).hexdigest()
+                    self.file_hashes[key] = digest
+                return digest
+            if kind == 'folder':
+                # The files themselves are separate dependencies, this only tracks added and removed files.
+                # Names are relative to the folder, so the hash is the same wherever the site is checked out.
+                names = (os.path.relpath(file, target).replace(os.sep, '/') for file in self.include_cache.folder_files(target))
+                return hashlib.sha256('\n'.join(names).encode()).hexdigest()
+            if kind == 'native':
+                target = native_include_url + target
+            return hashlib.sha256(self.remote_cache.get(target).encode('utf-8')).hexdigest()
+        except (OSError, FetchError):
+            return None
+
+def page_record(ctx, input_file, hasher):
+    """
+    Manifest entry of a compiled page: its inputs with their hashes and the declarations it uses.
+    """
+    return {
+        "source": hasher.hash(f'file:{input_file}'),
+        "inputs": {dependency: hasher.hash(dependency) for dependency in sorted(ctx.dependencies)},
+        "components": sorted(ctx.used_components),
+        "variables": sorted(ctx.used_variables),
+        "hashmaps": sorted(ctx.used_hashmaps),
+    }
+
+def page_up_to_date(record, input_file, output_file, hasher):
+    if record is None or not os.path.exists(output_file):
+        return False
+    if hasher.hash(f'file:{input_file}') != record["source"]:
+        return False
+    return all(hasher.hash(dependency) == digest for dependency, digest in record["inputs"].items())
+
+def load_manifest(out_dir, legacy, optimize=False, aliases=default_aliases):
+    """
+    The manifest of the previous build into out_dir, or an empty one if it is missing
+    or was written by another compiler version, pipeline, output mode or aliases.
+    """
+    try:
+        with open(os.path.join(out_dir, manifest_name), 'r') as f:
+            manifest = json.load(f)
+        if (manifest.get("compiler") == __version__ and manifest.get("legacy") == legacy and manifest.get("optimize", False) == optimize
+                and manifest.get("aliases") == aliases.fingerprint):
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {"pages": {}}
+
+def write_manifest(out_dir, legacy, pages, optimize=False, aliases=default_aliases):
+    manifest = {"compiler": __version__, "legacy": legacy, "optimize": optimize, "aliases": aliases.fingerprint, "pages": pages}
+    write_bytes(os.path.join(out_dir, manifest_name), json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+
+# Content hashes of the output of an optimized build, for deploy tools that only upload changed files
+content_manifest_name = 'content-hashes.json'
+
+def load_content_manifest(out_dir):
+    """
+    Output path (relative to out_dir, with / separators) -> precompress() record of the last optimized build.
+    """
+    try:
+        with open(os.path.join(out_dir, content_manifest_name), 'r') as f:
+            return json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+def write_content_manifest(out_dir, files):
+    write_bytes(os.path.join(out_dir, content_manifest_name), json.dumps({"files": files}, indent=1, sort_keys=True).encode('utf-8'))
+
+def output_key(out_dir, output_file):
+    return os.path.relpath(output_file, out_dir).replace(os.sep, '/')
+
+# Shared build cache
+
+# Bumped whenever the layout of build cache entries changes
+build_cache_format = 1
+# Size a build cache folder may grow to before its least recently used entries are removed
+default_build_cache_size = 1 << 30
+
+class DirectoryStore:
+    """
+    Build cache entries in a folder, local or on a filesystem mounted on every build machine.
+    Entries are files named by their key and replaced atomically, so concurrent builds can
+    share the folder. Reading an entry refreshes its modification time, which evict() uses
+    to remove the least recently used entries once the folder is larger than max_size.
+
+    Any picklable object with the same get(), put() and evict() methods can be used as the
+    store of a BuildCache instead (it is passed to the build worker processes).
+    """
+
+    def __init__(self, path, max_size=default_build_cache_size):
+        self.path = path
+        self.max_size = max_size
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        """
+        The bytes stored under key, or None.
+        """
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        write_cache_file(self.entry_path(key), data)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the folder fits in max_size.
+        Returns (entries removed, bytes removed, bytes left).
+        """
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Removed by another build in the meantime
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+        size = sum(entry_size for _, entry_size, _ in entries)
+        removed = removed_size = 0
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            removed += 1
+            removed_size += entry_size
+        return removed, removed_size, size
+
+def relative_dependency(dependency, page_dir):
+    kind, target = dependency.split(':', 1)
+    if kind in ('file', 'folder'):
+        return f"{kind}:{os.path.relpath(target, page_dir).replace(os.sep, '/')}"
+    return dependency
+
+def absolute_dependency(dependency, page_dir):
+    kind, target = dependency.split(':', 1)
+    if kind in ('file', 'folder'):
+        return f"{kind}:{os.path.normpath(os.path.join(page_dir, target))}"
+    return dependency
+
+class BuildCache:
+    """
+    Compiled pages shared between builds, and between machines when the store is shared.
+    A page is looked up by the hash of its source, the compiler version, the build
+    options and the aliases. That index lists the inputs the page read when it was compiled (includes,
+    folder listings, native and remote includes). If they still have the same content,
+    the page is taken from the entry stored under the hash of all of them, without
+    compiling it. Every variable, hashmap and component a page uses is declared in the
+    page or in one of those inputs, so their values are covered by the hashes as well.
+    Inputs are recorded relative to the page, so checkouts in different places share entries.
+    """
+
+    # Input lists kept per source, for a page that is built against different includes, e.g. on several branches
+    max_input_lists = 8
+
+    def __init__(self, store, legacy=False, optimize=False, aliases=default_aliases):
+        self.store = store
+        self.legacy = legacy
+        self.optimize = optimize
+        self.aliases = aliases
+
+    def source_key(self, source_hash):
+        key = json.dumps([build_cache_format, __version__, self.legacy, self.optimize, self.aliases.fingerprint, source_hash])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def entry_key(self, source_key, inputs):
+        return hashlib.sha256(json.dumps([source_key, sorted(inputs.items())]).encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        data = self.store.get(key)
+        if data is None:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return None
+
+    def save(self, key, value):
+        self.store.put(key, json.dumps(value, separators=(',', ':')).encode('utf-8'))
+
+    def lookup(self, input_file, hasher):
+        """
+        (html_content, messages, manifest record) of a page whose inputs are unchanged
+        since it was stored, or None.
+        """
+        source_hash = hasher.hash(f'file:{input_file}')
+        if source_hash is None:
+            return None
+        page_dir = os.path.dirname(input_file)
+        source_key = self.source_key(source_hash)
+        index = self.load(source_key)
+        for names in (index or {}).get("inputs", ()):
+            inputs = {name: hasher.hash(absolute_dependency(name, page_dir)) for name in names}
+            if None in inputs.values():
+                continue
+            entry = self.load(self.entry_key(source_key, inputs))
+            if entry is not None:
+                record = {
+                    "source": source_hash,
+                    "inputs": {absolute_dependency(name, page_dir): digest for name, digest in inputs.items()},
+                    "components": entry["components"],
+                    "variables": entry["variables"],
+                    "hashmaps": entry["hashmaps"],
+                }
+                return entry["html"], entry["messages"], record
+        return None
+
+    def store_page(self, input_file, record, html_content, messages):
+        """
+        Store a compiled page under its manifest record (see page_record).
+        """
+        page_dir = os.path.dirname(input_file)
+        inputs = {relative_dependency(dependency, page_dir): digest for dependency, digest in record["inputs"].items()}
+        if record["source"] is None or None in inputs.values():
+            return False
+        source_key = self.source_key(record["source"])
+        self.save(self.entry_key(source_key, inputs), {
+            "html": html_content,
+            "messages": messages,
+            "components": record["components"],
+            "variables": record["variables"],
+            "hashmaps": record["hashmaps"],
+        })
+        names = sorted(inputs)
+        index = self.load(source_key) or {}
+        others = [other for other in index.get("inputs", ()) if other != names]
+        self.save(source_key, {"inputs": [names] + others[:self.max_input_lists - 1]})
+        return True
+
+class BuildResult:
+    """
+    Outcome of building one page. record is its manifest entry, or None if the page
+    has to be compiled again on the next incremental build.
+    """
+
+    def __init__(self, input_file, output_file, failed=False, messages=(), record=None, skipped=False, timings=None, usage=None,
+                 content=None, cache=None):
+        self.input_file = input_file
+        self.output_file = output_file
+        self.failed = failed
+        self.messages = list(messages)
+        self.record = record
+        self.skipped = skipped
+        self.timings = timings
+        # declaration_usage() of the page, when the build reports unused declarations
+        self.usage = usage
+        # precompress() record of the output, in optimized builds
+        self.content = content
+        # With a build cache: "hit" (taken from the cache), "stored" (compiled and stored) or "miss"
+        self.cache = cache
+
+# Compiler and dependency hasher of the current build worker process, reused for every page it compiles
+build_compiler = None
+build_hasher = None
+build_usage = False
+build_cache = None
+
+def init_build_worker(legacy, cache_options, timings=False, usage=False, optimize=False, cache_store=None, aliases=None,
+                      write_modules=None):
+    global build_compiler, build_hasher, build_usage, build_cache
+    build_compiler = Compiler(legacy, remote_cache=RemoteCache(*cache_options), timings=timings, optimize=optimize, aliases=aliases,
+                              write_modules=write_modules)
+    build_hasher = DependencyHasher(build_compiler.remote_cache, build_compiler.include_cache)
+    build_usage = usage
+    build_cache = BuildCache(cache_store, legacy, optimize, build_compiler.aliases) if cache_store is not None else None
+
+def build_page(input_file, output_file, previous_content=None):
+    """
+    Compile one page in a build worker, or take it from the build cache. Optimized pages
+    are compressed in the worker as well.
+    """
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    # Declaration usage is only known after a compile
+    if build_cache is not None and not build_usage:
+        cached = build_cache.lookup(input_file, build_hasher)
+        if cached is not None:
+            html_content, messages, record = cached
+            with open(output_file, "w") as html_file:
+                html_file.write(html_content)
+            content = precompress(output_file, previous_content) if build_compiler.optimize else None
+            return BuildResult(input_file, output_file, False, messages, record, content=content, cache="hit")
+
+    ctx = build_compiler.new_context()
+    try:
+        build_compiler.compile_file(input_file, output_file, ctx)
+    except Exception as e:
+        return BuildResult(input_file, output_file, True, compile_messages(ctx) + [f"Error: {type(e).__name__}: {e}"], timings=ctx.timings,
+                           cache="miss" if build_cache is not None else None)
+    # Pages with errors (e.g. a missing include) are always compiled again
+    record = None if ctx.errors else page_record(ctx, input_file, build_hasher)
+    messages = compile_messages(ctx)
+    cache = None
+    if build_cache is not None:
+        cache = "miss"
+        # Pages with values that change on every compile (new uuid) are not stored
+        if record is not None and not ctx.volatile:
+            with open(output_file, "r") as html_file:
+                if build_cache.store_page(input_file, record, html_file.read(), messages):
+                    cache = "stored"
+    usage = declaration_usage(ctx) if build_usage else None
+    content = precompress(output_file, previous_content) if build_compiler.optimize else None
+    return BuildResult(input_file, output_file, False, messages, record, timings=ctx.timings, usage=usage, content=content, cache=cache)
+
+def page_output_file(out_dir, relative_path):
+    return os.path.join(out_dir, os.path.splitext(relative_path)[0] + '.html')
+
+def build_site(src_dir, out_dir, jobs=None, legacy=False, remote_cache=None, incremental=False, timings=False, usage=False,
+               optimize=False, cache_store=None, aliases=None, write_modules=None):
+    """
+    Compile every page below src_dir into out_dir, keeping the folder layout,
+    across a pool of jobs worker processes (all cores by default).
+    The dependency graph of every page is stored in a manifest in out_dir. With
+    incremental, pages whose source and inputs have the same hashes as in the
+    manifest are skipped. With timings, every compiled page records a CompileTimings,
+    with usage its declaration_usage(). With optimize, pages are minified and
+    precompressed by the workers, and their content hashes are written to
+    content_manifest_name in out_dir. With a cache_store (e.g. a DirectoryStore), pages are
+    taken from and added to a BuildCache in it. Tags and attributes are converted
+    with aliases (the built-in ones by default). write_modules=False stops the workers
+    from writing compiled modules of includes.
+    Returns a list of BuildResult in page order.
+    """
+    if remote_cache is None:
+        remote_cache = RemoteCache()
+    if aliases is None:
+        aliases = default_aliases
+    src_dir = os.path.abspath(src_dir)
+    pages = find_pages(src_dir)
+    tasks = [(page, page_output_file(out_dir, os.path.relpath(page, src_dir))) for page in pages]
+
+    # Warm the disk cache once so the workers do not all download the same files
+    warm_remote_cache(remote_cache, [src_dir])
+
+    old_records = load_manifest(out_dir, legacy, optimize, aliases)["pages"]
+    old_content = load_content_manifest(out_dir) if optimize else {}
+    results = {}
+    if incremental:
+        hasher = DependencyHasher(remote_cache, IncludeCache())
+        for input_file, output_file in tasks:
+            record = old_records.get(os.path.relpath(input_file, src_dir))
+            if page_up_to_date(record, input_file, output_file, hasher):
+                results[input_file] = BuildResult(input_file, output_file, record=record, skipped=True,
+                                                  content=old_content.get(output_key(out_dir, output_file)))
+    pending = [task + (old_content.get(output_key(out_dir, task[1])),) for task in tasks if task[0] not in results]
+
+    cache_options = (remote_cache.cache_dir, remote_cache.ttl, remote_cache.offline, remote_cache.timeout)
+    from concurrent.futures import ProcessPoolExecutor
+    if jobs == 1 or len(pending) <= 1:
+        init_build_worker(legacy, cache_options, timings, usage, optimize, cache_store, aliases, write_modules)
+        for task in pending:
+            results[task[0]] = build_page(*task)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_build_worker,
+                                 initargs=(legacy, cache_options, timings, usage, optimize, cache_store, aliases,
+                                           write_modules)) as executor:
+            for result in executor.map(build_page, *zip(*pending)):
+                results[result.input_file] = result
+
+    records = {os.path.relpath(page, src_dir): results[page].record for page in pages if results[page].record is not None}
+    # Remove the output of pages that no longer exist
+    for relative_path in old_records:
+        if relative_path not in records and not os.path.exists(os.path.join(src_dir, relative_path)):
+            output_file = page_output_file(out_dir, relative_path)
+            for path in (output_file, output_file + '.gz', output_file + '.br'):
+                if os.path.exists(path):
+                    os.remove(path)
+    write_manifest(out_dir, legacy, records, optimize, aliases)
+    if optimize:
+        write_content_manifest(out_dir, {
+            output_key(out_dir, result.output_file): result.content for result in results.values() if result.content is not None
+        })
+    return [results[page] for page in pages]
+
+def build_command(argv):
+    parser = argparse.ArgumentParser(prog="mml_converter.py build", description="Compile every page of a site.")
+    parser.add_argument("src", help="source folder containing the .mml pages")
+    parser.add_argument("-o", "--output", default="out", help="output folder (default: out)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--incremental", action="store_true", help="only compile pages whose source or inputs changed since the last build")
+    parser.add_argument("--legacy", action="store_true", help="use the original regex conversion pipeline")
+    parser.add_argument("--report-unused", action="store_true",
+                        help="list the components, variables and hashmaps no page uses (compiles every page, ignores --incremental)")
+    parser.add_argument("--optimize", action="store_true",
+                        help=f"minify the pages, write .gz/.br copies next to them and their content hashes to {content_manifest_name}")
+    parser.add_argument("--build-cache", metavar="DIR", default=os.environ.get("MML_BUILD_CACHE"),
+                        help="reuse compiled pages from this folder and add new ones, e.g. a folder shared by all CI machines "
+                             "(default: $MML_BUILD_CACHE)")
+    parser.add_argument("--build-cache-size", metavar="MB", type=int, default=default_build_cache_size >> 20,
+                        help=f"remove the least recently used pages from the build cache beyond this size (default: {default_build_cache_size >> 20})")
+    add_timing_arguments(parser)
+    add_cache_arguments(parser)
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+    aliases = aliases_from_args(parser, args, args.src)
+
+    cache_store = DirectoryStore(args.build_cache, args.build_cache_size << 20) if args.build_cache else None
+    start_time = time.perf_counter()
+    results = build_site(args.src, args.output, args.jobs, args.legacy, remote_cache_from_args(args),
+                         args.incremental and not args.report_unused, args.timings or args.trace is not None, args.report_unused,
+                         args.optimize, cache_store, aliases, write_modules_from_args(args))
+    elapsed = time.perf_counter() - start_time
+    report_timings(args, CompileTimings.merge(result.timings for result in results if result.timings is not None))
+
+    compiled = [result for result in results if not result.skipped]
+    failed = [result for result in compiled if result.failed]
+    print(f"Compiled {len(compiled) - len(failed)} of {len(compiled)} pages in {elapsed:.2f}s "
+          f"({len(results) - len(compiled)} up to date)")
+    if cache_store is not None:
+        hits = sum(result.cache == "hit" for result in compiled)
+        stored = sum(result.cache == "stored" for result in compiled)
+        removed, removed_size, size = cache_store.evict()
+        print(f"Build cache: {hits} hits, {len(compiled) - hits} misses"
+              f"{f' ({hits / len(compiled):.1%} hit rate)' if compiled else ''}, {stored} pages stored, "
+              f"{size / 1e6:.1f} MB in {args.build_cache} ({removed} entries / {removed_size / 1e6:.1f} MB evicted)")
+    with_messages = [result for result in compiled if result.messages]
+    if with_messages:
+        print("\nProblems:")
+        for result in with_messages:
+            print(f"  {os.path.relpath(result.input_file)}:")
+            for message in result.messages:
+                print(f"    {message}")
+    if args.report_unused:
+        print()
+        print(format_unused(unused_declarations(result.usage for result in results if result.usage is not None)))
+    return 1 if failed or any(message.startswith("Error") for result in compiled for message in result.messages) else 0
+
+# Watch mode and development server
+
+class SiteWatcher:
+    """
+    Keeps a site compiled while its sources change. Sources and include files are
+    polled, parsed includes stay in memory between rebuilds and only the pages
+    whose inputs changed are compiled again.
+    """
+
+    def __init__(self, src_dir, out_dir, remote_cache=None, aliases=None, write_modules=None):
+        self.src_dir = os.path.abspath(src_dir)
+        self.out_dir = out_dir
+        self.compiler = Compiler(remote_cache=remote_cache, aliases=aliases, write_modules=write_modules)
+        self.hasher = DependencyHasher(self.compiler.remote_cache, self.compiler.include_cache)
+        # Manifest record of every page by path, None if its dependencies are unknown
+        self.records = {}
+        self.snapshot = {}
+        # Bumped after every rebuild, live reload clients wait for it to change
+        self.version = 0
+        self.rebuilt = threading.Condition()
+
+    def build(self):
+        """
+        Compile every page that changed since the last build and start watching.
+        """
+        results = build_site(self.src_dir, self.out_dir, remote_cache=self.compiler.remote_cache, incremental=True,
+                             aliases=self.compiler.aliases, write_modules=self.compiler.write_modules)
+        self.records = {result.input_file: result.record for result in results}
+        self.snapshot = self.take_snapshot()
+        return results
+
+    def watched_files(self):
+        files = {os.path.abspath(file) for file in collect_mml_files([self.src_dir])}
+        for record in self.records.values():
+            if record is not None:
+                # Folders are watched too, their modification time changes when files are added or removed
+                files.update(dependency.split(':', 1)[1] for dependency in record["inputs"] if dependency.startswith(('file:', 'folder:')))
+        return files
+
+    def take_snapshot(self):
+        snapshot = {}
+        for path in self.watched_files():
+            try:
+                stat = os.stat(path)
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                pass
+        return snapshot
+
+    def affected_pages(self, changed):
+        """
+        Pages that have to be compiled again after the given files changed.
+        """
+        affected = []
+        for page, record in self.records.items():
+            if page in changed or record is None:
+                affected.append(page)
+                continue
+            for dependency in record["inputs"]:
+                kind, target = dependency.split(':', 1)
+                if kind == 'file' and target in changed:
+                    break
+                if kind == 'folder' and any(path == target or path.startswith(target + os.sep) for path in changed):
+                    break
+            else:
+                continue
+            affected.append(page)
+        return affected
+
+    def poll(self):
+        """
+        Check the sources once and recompile the affected pages.
+        Returns a list of (input_file, BuildResult) for the compiled pages.
+        """
+        snapshot = self.take_snapshot()
+        changed = {path for path in snapshot.keys() | self.snapshot.keys() if snapshot.get(path) != self.snapshot.get(path)}
+        if not changed:
+            return []
+
+        # Files were added or removed, so the set of pages may be different
+        if snapshot.keys() != self.snapshot.keys():
+            pages = find_pages(self.src_dir)
+            for page in set(self.records) - set(pages):
+                del self.records[page]
+                output_file = page_output_file(self.out_dir, os.path.relpath(page, self.src_dir))
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+            for page in pages:
+                self.records.setdefault(page, None)
+
+        results = []
+        for page in self.affected_pages(changed):
+            output_file = page_output_file(self.out_dir, os.path.relpath(page, self.src_dir))
+            start_time = time.perf_counter()
+            ctx = self.compiler.new_context()
+            try:
+                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+                self.compiler.compile_file(page, output_file, ctx)
+                result = BuildResult(page, output_file, False, compile_messages(ctx))
+                result.record = None if ctx.errors else page_record(ctx, page, self.hasher)
+            except Exception as e:
+                result = BuildResult(page, output_file, True, compile_messages(ctx) + [f"Error: {type(e).__name__}: {e}"])
+            result.elapsed = time.perf_counter() - start_time
+            self.records[page] = result.record
+            results.append(result)
+
+        # Keep the state seen before compiling, so edits made during the rebuild are picked up next time
+        new_snapshot = self.take_snapshot()
+        new_snapshot.update((path, state) for path, state in snapshot.items() if path in new_snapshot)
+        self.snapshot = new_snapshot
+        with self.rebuilt:
+            self.version += 1
+            self.rebuilt.notify_all()
+        return results
+
+    def write_manifest(self):
+        records = {os.path.relpath(page, self.src_dir): record for page, record in self.records.items() if record is not None}
+        write_manifest(self.out_dir, False, records, aliases=self.compiler.aliases)
+
+    def run(self, interval=0.1):
+        """
+        Poll until interrupted, printing what was compiled.
+        """
+        try:
+            while True:
+                for result in self.poll():
+                    status = "Failed" if result.failed else "Compiled"
+                    print(f"{status} {os.path.relpath(result.input_file)} in {result.elapsed * 1000:.1f} ms")
+                    for message in result.messages:
+                        print(f"    {message}")
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.write_manifest()
+
+# Added to every page served by the development server
+live_reload_script = (
+    '<script>new EventSource("/__mml_reload?v={version}")'
+    '.onmessage = function () {{ location.reload(); }};</script>'
+)
+
+def inject_live_reload(html_content, version):
+    script = live_reload_script.format(version=version).encode()
+    position = html_content.rfind(b'</body>')
+    if position == -1:
+        return html_content + script
+    return html_content[:position] + script + html_content[position:]
+
+@lru_cache(maxsize=None)
+def live_reload_handler():
+    """
+    The request handler class of the dev server, defined on first use so that only
+    the serve command imports http.server.
+    """
+    import http.server
+
+    class LiveReloadHandler(http.server.SimpleHTTPRequestHandler):
+        """
+        Serves the output folder, adds the live reload script to HTML pages and
+        streams a reload event to the browser after every rebuild.
+        """
+        watcher = None
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            if path == '/__mml_reload':
+                self.send_reload_event(query)
+                return
+            file_path = self.translate_path(self.path)
+            if os.path.isdir(file_path) and path.endswith('/'):
+                file_path = os.path.join(file_path, 'index.html')
+            if not file_path.endswith('.html') or not os.path.isfile(file_path):
+                super().do_GET()
+                return
+            with open(file_path, 'rb') as f:
+                body = inject_live_reload(f.read(), self.watcher.version)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_reload_event(self, query):
+            version = parse_qs(query).get('v', [str(self.watcher.version)])[0]
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            try:
+                while True:
+                    with self.watcher.rebuilt:
+                        self.watcher.rebuilt.wait_for(lambda: str(self.watcher.version) != version, timeout=15)
+                    if str(self.watcher.version) != version:
+                        self.wfile.write(b'data: reload\n\n')
+                        self.wfile.flush()
+                        return
+                    # Keep the connection alive and notice closed tabs
+                    self.wfile.write(b': ping\n\n')
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    return LiveReloadHandler
+
+def start_dev_server(watcher, host, port):
+    import http.server
+    handler = type('SiteHandler', (live_reload_handler(),), {'watcher': watcher})
+    server = http.server.ThreadingHTTPServer((host, port), partial(handler, directory=watcher.out_dir))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def watch_command(argv, serve=False):
+    name = "serve" if serve else "watch"
+    parser = argparse.ArgumentParser(
+        prog=f"mml_converter.py {name}",
+        description="Compile a site and recompile changed pages on save" + (", and serve it with live reload." if serve else "."),
+    )
+    parser.add_argument("src", help="source folder containing the .mml pages")
+    parser.add_argument("-o", "--output", default="out", help="output folder (default: out)")
+    parser.add_argument("--interval", type=float, default=0.1, help="seconds between checks for changes (default: 0.1)")
+    if serve:
+        parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+        parser.add_argument("--port", type=int, default=8000, help="port to listen on (default: 8000)")
+    add_cache_arguments(parser)
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+    aliases = aliases_from_args(parser, args, args.src)
+
+    watcher = SiteWatcher(args.src, args.output, remote_cache_from_args(args), aliases, write_modules_from_args(args))
+    results = watcher.build()
+    print(f"Compiled {len(results)} pages, watching {os.path.relpath(watcher.src_dir)} for changes (Ctrl+C to stop)")
+    if serve:
+        server = start_dev_server(watcher, args.host, args.port)
+        print(f"Serving {args.output} at http://{args.host}:{server.server_address[1]}/")
+    watcher.run(args.interval)
+    return 0
+
+def serve_command(argv):
+    return watch_command(argv, serve=True)
+
+# Render daemon
+
+def escape_request_value(value):
+    """
+    A value sent with a render request with its text HTML-escaped, including the strings
+    in lists and objects, so a request cannot put markup into the page.
+    """
+    if isinstance(value, str):
+        import html
+        return html.escape(value)
+    if isinstance(value, list):
+        return [escape_request_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: escape_request_value(item) for key, item in value.items()}
+    return value
+
+class Renderer:
+    """
+    Renders components and MML fragments on request. The declarations of a set of
+    includes (files, folders or URLs) are loaded once and reloaded when a local one
+    changes. Rendered output is kept in an LRU cache keyed by the whole request.
+    Safe to use from many threads.
+    """
+
+    def __init__(self, includes, compiler=None, cache_size=1024, reload_interval=1.0):
+        self.includes = list(includes)
+        self.compiler = compiler if compiler is not None else Compiler()
+        self.cache_size = cache_size
+        self.reload_interval = reload_interval
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.base = None
+        self.states = {}
+        self.checked_at = 0.0
+
+    def load(self):
+        """
+        Load the declarations of the includes. Returns the errors and warnings reported while loading.
+        """
+        base = self.compiler.new_context(os.getcwd())
+        content = ''.join(f'!include [{path}]\n' for path in self.includes)
+        for name, stage in pipeline_stages:
+            content = run_stage(base, name, stage, content)
+        states = {
+            dependency: self.compiler.include_cache.dependency_state(dependency)
+            for dependency in base.dependencies if dependency.startswith(('file:', 'folder:'))
+        }
+        with self.lock:
+            self.base = base
+            self.states = states
+            self.checked_at = time.monotonic()
+            self.cache.clear()
+        return compile_messages(base)
+
+    def check_reload(self):
+        """
+        Reload if a local include changed, checking at most once per reload_interval.
+        """
+        now = time.monotonic()
+        if now - self.checked_at < self.reload_interval:
+            return
+        self.checked_at = now
+        include_cache = self.compiler.include_cache
+        if any(include_cache.dependency_state(dependency) != state for dependency, state in self.states.items()):
+            self.load()
+
+    def new_context(self, variables=None, hashmaps=None, copy_values=False):
+        """
+        A compile context with the loaded declarations and the given variable and hashmap values.
+        """
+        base = self.base
+        ctx = self.compiler.new_context(base.base_dir)
+        ctx.components = dict(base.components)
+        # Fragments may reassign variables, which changes their entries in place
+        ctx.variables = {name: dict(var_info) for name, var_info in base.variables.items()} if copy_values else dict(base.variables)
+        ctx.hashmaps = dict(base.hashmaps)
+        for name, value in (variables or {}).items():
+            ctx.variables[name] = {"datatype": type_name(value), "vartype": "dynamic", "value": value}
+        for name, hashmap in (hashmaps or {}).items():
+            ctx.hashmaps[name] = dict(hashmap)
+        return ctx
+
+    def render(self, component=None, fragment=None, arguments=None, variables=None, hashmaps=None, escape=True):
+        """
+        Render a component called with arguments, or an MML fragment. Returns
+        (html, messages, cached). Raises KeyError for an unknown component.
+        The argument, variable and hashmap values are HTML-escaped unless escape is False.
+        """
+        if self.base is None:
+            self.load()
+        else:
+            self.check_reload()
+        key = json.dumps([component, fragment, arguments, variables, hashmaps, escape], sort_keys=True, default=str)
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return cached + (True,)
+            self.misses += 1
+
+        if escape:
+            arguments, variables, hashmaps = (escape_request_value(value) for value in (arguments, variables, hashmaps))
+        if component is not None:
+            ctx = self.new_context(variables, hashmaps)
+            template = ctx.components.get(component)
+            if template is None:
+                raise KeyError(component)
+            arguments = tuple((name, str(value)) for name, value in (arguments or {}).items())
+            html_content = render_component(ctx, template, arguments)
+        else:
+            ctx = self.new_context(variables, hashmaps, copy_values=True)
+            # Fragments come from the network, they must not read local files or fetch URLs
+            ctx.allow_includes = False
+            html_content = self.compiler.compile_string(fragment or '', ctx)
+        result = (html_content, compile_messages(ctx))
+
+        with self.lock:
+            self.cache[key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result + (False,)
+
+@lru_cache(maxsize=None)
+def render_server_classes():
+    """
+    The (RenderHandler, RenderServer, UnixRenderServer) classes of the render daemon,
+    defined on first use so that only the daemon command imports http.server.
+    """
+    import http.server
+    import socket
+    import socketserver
+
+    class RenderHandler(http.server.BaseHTTPRequestHandler):
+        """
+        HTTP interface of a Renderer:
+
+            POST /render              {"component": "card", "arguments": {...}, "variables": {...}, "hashmaps": {...}}
+                                      or {"fragment": "(&text){:name:}.&text", "variables": {...}}
+            GET  /component/<name>    the query parameters are the component arguments
+            GET  /health
+        """
+        renderer = None
+        # Keep connections open, a new connection per fragment would dominate the latency
+        protocol_version = "HTTP/1.1"
+        # Buffer the response so headers and body leave in one write once the request
+        # is handled, separate small writes stall on delayed ACKs
+        wbufsize = -1
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_text(self, status, body, content_type="text/plain; charset=utf-8", headers=()):
+            body = body.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_render(self, **request):
+            try:
+                html_content, messages, cached = self.renderer.render(**request)
+            except KeyError as e:
+                self.send_text(404, f"Unknown component {e}\n")
+                return
+            headers = [("X-MML-Cache", "hit" if cached else "miss")]
+            if messages:
+                headers.append(("X-MML-Messages", "; ".join(messages)))
+            self.send_text(200, html_content, "text/html; charset=utf-8", headers)
+
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            if path == '/health':
+                self.send_text(200, "ok\n")
+            elif path.startswith('/component/'):
+                arguments = {name: values[-1] for name, values in parse_qs(query).items()}
+                self.send_render(component=path[len('/component/'):], arguments=arguments)
+            else:
+                self.send_text(404, "Not found\n")
+
+        def do_POST(self):
+            if self.path != '/render':
+                self.send_text(404, "Not found\n")
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b'{}')
+                if not isinstance(request, dict) or set(request) - {"component", "fragment", "arguments", "variables", "hashmaps"}:
+                    raise ValueError("expected an object with component or fragment, arguments, variables and hashmaps")
+                if ("component" in request) == ("fragment" in request):
+                    raise ValueError("expected either component or fragment")
+                for field in ("component", "fragment"):
+                    if not isinstance(request.get(field, ''), str):
+                        raise ValueError(f"{field} must be a string")
+                for field in ("arguments", "variables", "hashmaps"):
+                    if not isinstance(request.get(field) or {}, dict):
+                        raise ValueError(f"{field} must be an object")
+                if not all(isinstance(hashmap, dict) for hashmap in (request.get("hashmaps") or {}).values()):
+                    raise ValueError("every hashmap must be an object")
+            except ValueError as e:
+                self.send_text(400, f"Bad request: {e}\n")
+                return
+            self.send_render(**request)
+
+    class RenderServer(http.server.ThreadingHTTPServer):
+        daemon_threads = True
+        # The default backlog of 5 resets connections when a burst of clients connects at once
+        request_queue_size = socket.SOMAXCONN
+
+    class UnixRenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+        request_queue_size = socket.SOMAXCONN
+
+        def get_request(self):
+            # BaseHTTPRequestHandler expects a (host, port) client address
+            request, _ = super().get_request()
+            return request, ("unix", 0)
+
+    return RenderHandler, RenderServer, UnixRenderServer
+
+def start_render_server(renderer, host="127.0.0.1", port=8100, socket_path=None):
+    """
+    Create a threaded HTTP server for renderer on host:port, or on a Unix socket.
+    Call serve_forever() on the result to handle requests.
+    """
+    RenderHandler, RenderServer, UnixRenderServer = render_server_classes()
+    handler = type('Handler', (RenderHandler,), {'renderer': renderer})
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return UnixRenderServer(socket_path, handler)
+    return RenderServer((host, port), handler)
+
+def daemon_command(argv):
+    parser = argparse.ArgumentParser(
+        prog="mml_converter.py daemon",
+        description="Keep components loaded and render them or MML fragments on request, e.g. for htmx.",
+    )
+    parser.add_argument("includes", nargs="+", help="files, folders or URLs with the components, variables and hashmaps to load")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8100, help="port to listen on (default: 8100)")
+    parser.add_argument("--socket", help="listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--cache-size", type=int, default=1024, help="rendered responses kept in memory (default: 1024)")
+    add_cache_arguments(parser)
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+    aliases = aliases_from_args(parser, args, os.getcwd())
+
+    compiler = Compiler(remote_cache=remote_cache_from_args(args), aliases=aliases, write_modules=write_modules_from_args(args))
+    renderer = Renderer(args.includes, compiler, args.cache_size)
+    for message in renderer.load():
+        print(message)
+    server = start_render_server(renderer, args.host, args.port, args.socket)
+    address = args.socket or f"http://{args.host}:{server.server_address[1]}/"
+    print(f"Loaded {len(renderer.base.components)} components, rendering on {address} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+    return 0
+
+def collect_mml_files(paths):
+    mml_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                mml_files.extend(os.path.join(root, file) for file in files if file.endswith('.mml'))
+        elif os.path.isfile(path):
+            mml_files.append(path)
+    return mml_files
+
+def warm_remote_cache(remote_cache, paths):
+    """
+    Fetch every native and remote include used by the .mml files in paths (files or folders)
+    and by the fetched files themselves. Returns {url: content or FetchError}.
+    """
+    urls = [path for path in paths if path.startswith(('http://', 'https://'))]
+    for mml_file in collect_mml_files(paths):
+        with open(mml_file, 'r') as f:
+            urls.extend(remote_include_urls(f.read()))
+
+    results = {}
+    while urls:
+        remote_cache.prefetch(urls)
+        new_urls = []
+        for url in dict.fromkeys(urls):
+            try:
+                results[url] = remote_cache.get(url)
+                new_urls.extend(remote_include_urls(results[url]))
+            except FetchError as e:
+                results[url] = e
+        urls = [url for url in new_urls if url not in results]
+    return results
+
+def fetch_command(argv):
+    parser = argparse.ArgumentParser(prog="mml_converter.py fetch", description="Download remote and native includes into the include cache.")
+    parser.add_argument("paths", nargs="*", default=["."], help=".mml files, folders or URLs to fetch includes for (default: current folder)")
+    parser.add_argument("--native", action="append", default=[], metavar="FILE", help="also fetch this native include (e.g. std.mml)")
+    parser.add_argument("--cache-dir", default=None, help="include cache folder (default: ~/.cache/mml)")
+    args = parser.parse_args(argv)
+
+    # Revalidate everything, pre-warming should not trust entries that are still fresh
+    remote_cache = RemoteCache(args.cache_dir, ttl=0)
+    results = warm_remote_cache(remote_cache, args.paths + [native_include_url + name for name in args.native])
+    failed = {url: error for url, error in results.items() if isinstance(error, FetchError)}
+    print(f"Cached {len(results) - len(failed)} of {len(results)} includes in {remote_cache.cache_dir}")
+    for url, error in failed.items():
+        print(f"  Error fetching {url}: {error}")
+    return 1 if failed else 0
+
+def add_cache_arguments(parser):
+    parser.add_argument("--offline", action="store_true", help="only use cached copies of remote and native includes")
+    parser.add_argument("--cache-dir", default=None, help="include cache folder (default: ~/.cache/mml)")
+    parser.add_argument("--cache-ttl", type=float, default=default_cache_ttl, help=f"seconds before a cached include is revalidated (default: {default_cache_ttl})")
+    parser.add_argument("--no-mmlc", action="store_true", help="don't write compiled .mmlc modules of includes")
+
+def remote_cache_from_args(args):
+    return RemoteCache(args.cache_dir, args.cache_ttl, args.offline)
+
+def write_modules_from_args(args):
+    # Without --no-mmlc, MML_DONT_WRITE_MMLC decides
+    return False if args.no_mmlc else None
+
+def add_config_arguments(parser):
+    parser.add_argument("--config", metavar="FILE",
+                        help=f"project configuration with tag and attribute aliases (default: the nearest {project_config_name})")
+
+def aliases_from_args(parser, args, start_dir):
+    """
+    The Aliases of the --config file, or of the nearest project configuration above
+    start_dir, or the built-in ones if there is none.
+    """
+    path = args.config or find_project_config(start_dir)
+    if path is None:
+        return default_aliases
+    try:
+        return load_project_config(path)
+    except ConfigError as e:
+        parser.error(str(e))
+
+def add_timing_arguments(parser):
+    parser.add_argument("--timings", action="store_true", help="print the time, size and regex passes of every compile stage")
+    parser.add_argument("--trace", metavar="FILE", help="write a Chrome trace-event JSON file (open it in chrome://tracing or Perfetto)")
+
+def report_timings(args, timings):
+    if args.timings:
+        print(timings.format_table())
+    if args.trace is not None:
+        with open(args.trace, "w") as f:
+            json.dump(timings.trace(), f)
+
+# Subcommands of the command line interface
+commands = {
+    "build": build_command,
+    "fetch": fetch_command,
+    "watch": watch_command,
+    "serve": serve_command,
+    "daemon": daemon_command,
+}
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in commands:
+        return commands[argv[0]](argv[1:])
+
+    parser = argparse.ArgumentParser(
+        description="Compile MML files to HTML.",
+        epilog=f"commands: {', '.join(commands)} (run '<command> -h' for details)",
+    )
+    parser.add_argument("file", nargs="?", help="the .mml file to compile (the .mml suffix is optional)")
+    parser.add_argument("-o", "--output", help="output .html file (defaults to the input name with .html)")
+    parser.add_argument("--legacy", action="store_true", help="use the original regex conversion pipeline")
+    parser.add_argument("--stream", action="store_true", help="compile in chunks with bounded memory, for very large files")
+    parser.add_argument("--optimize", action="store_true", help="minify the HTML and write .gz/.br copies next to it")
+    add_timing_arguments(parser)
+    parser.add_argument("--profile", action="store_true", help="run the compile under cProfile and print the slowest functions")
+    parser.add_argument("--report-unused", action="store_true", help="list the components, variables and hashmaps the page does not use")
+    add_cache_arguments(parser)
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.stream and args.legacy:
+        parser.error("--stream cannot be used with --legacy")
+    if args.stream and args.optimize:
+        parser.error("--stream cannot be used with --optimize")
+
+    input_mml_file_name = args.file
+    if input_mml_file_name is None:
+        input_mml_file_name = input("Provide a valid .mml file (without the .mml suffix): ")
+    if not input_mml_file_name.endswith(".mml"):
+        input_mml_file_name += ".mml"
+    aliases = aliases_from_args(parser, args, os.path.dirname(os.path.abspath(input_mml_file_name)))
+    compile_args = (input_mml_file_name, args.output, args.legacy, remote_cache_from_args(args), args.timings or args.trace is not None,
+                    args.stream, args.optimize, aliases, write_modules_from_args(args))
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        ctx = profiler.runcall(compile_mml_to_html, *compile_args)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(30)
+    else:
+        ctx = compile_mml_to_html(*compile_args)
+    if ctx.timings is not None:
+        report_timings(args, ctx.timings)
+    if args.report_unused:
+        print(format_unused(unused_declarations([declaration_usage(ctx)])))
+    return 0
 
 # Main execution
-input_mml_file_name = input("Provide a valid .mml file (without the .mml suffix): ")
-input_mml_file = input_mml_file_name + ".mml"
-output_html_file = input_mml_file_name + ".html"
-compile_mml_to_html(input_mml_file, output_html_file)
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
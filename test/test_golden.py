@@ -0,0 +1,54 @@
+"""
+Compile every test/*.mml page with the tokenizer and the legacy pipeline and compare
+the output with the checked-in .html next to it.
+
+    python -m pytest test
+"""
+import functools
+import glob
+import http.server
+import os
+import re
+import sys
+import threading
+
+import pytest
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(test_dir)
+sys.path.insert(0, root_dir)
+
+import mml_converter
+
+# Pages with a .html to compare with, includes like testinclude.mml have none
+pages = sorted(path for path in glob.glob(os.path.join(test_dir, "*.mml")) if os.path.exists(path[:-len(".mml")] + ".html"))
+# new uuid values differ on every compile
+uuid_pattern = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+@pytest.fixture(scope="module")
+def native_url():
+    """
+    Serve the components folder over HTTP, so native includes are read from this checkout.
+    """
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=os.path.join(root_dir, "components"))
+    handler.log_message = lambda *args: None
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/"
+    server.shutdown()
+    server.server_close()
+
+@pytest.mark.parametrize("legacy", [False, True], ids=["tokenizer", "legacy"])
+@pytest.mark.parametrize("page", pages, ids=[os.path.basename(page) for page in pages])
+def test_page_matches_golden_html(page, legacy, native_url, tmp_path, monkeypatch):
+    # Include paths in the pages are relative to the repository root
+    monkeypatch.chdir(root_dir)
+    monkeypatch.setattr(mml_converter, "native_include_url", native_url)
+    compiler = mml_converter.Compiler(legacy=legacy, remote_cache=mml_converter.RemoteCache(str(tmp_path)), write_modules=False)
+    output_file = compiler.compile_file(page, str(tmp_path / "page.html"))
+    with open(output_file, "r", encoding="utf-8") as f:
+        html_content = f.read()
+    with open(page[:-len(".mml")] + ".html", "r", encoding="utf-8") as f:
+        expected = f.read()
+    assert uuid_pattern.sub("UUID", html_content) == uuid_pattern.sub("UUID", expected)
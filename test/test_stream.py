@@ -0,0 +1,49 @@
+"""
+The streaming compile must produce the same HTML as compiling the whole document,
+however the input is cut into chunks and however little lookahead the tokenizer keeps.
+
+    python -m pytest test
+"""
+import io
+import os
+import sys
+
+import pytest
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+sys.path.insert(0, os.path.join(root_dir, "benchmarks"))
+
+import corpus
+import mml_converter
+
+long_value = "x " * 300
+documents = {
+    "generated": corpus.generate_page(20_000, depth=4, variables=50, components=8, hashmaps=5, keys=3),
+    "generated, no declarations": corpus.generate_page(5_000, depth=3, variables=0, components=0, hashmaps=0),
+    # Tokens longer than the lookahead, and tokens that only end in the next chunk
+    "long tokens": (
+        "doc!.mml\nstatic str v = \"V\"\n"
+        f"(&ct cl.[{long_value}:v: {long_value}] id!\"{long_value}\"){{:v::v:?type}}.&ct\n"
+        f"!// a comment with (&ct a.[ and {long_value} //!\n"
+        "$export.card\n(&text cl.[card]){:title:}.&text\n$/export\n"
+        f"(@card title.[{long_value}]) (&in type.[text]) <text-editor>x</text-editor>\n"
+        "(&ct){ (& not a tag ( : :v :v. }.&ct (&a link.[unterminated\n"
+    ),
+}
+
+def compile_whole(document):
+    compiler = mml_converter.Compiler(remote_cache=mml_converter.RemoteCache(offline=True), write_modules=False)
+    return compiler.compile_string(document)
+
+def compile_streamed(document, chunk_size):
+    compiler = mml_converter.Compiler(remote_cache=mml_converter.RemoteCache(offline=True), write_modules=False)
+    return ''.join(mml_converter.stream_mml_to_html(io.StringIO(document), compiler.new_context(), chunk_size))
+
+@pytest.mark.parametrize("lookahead", [0, 16, 200])
+@pytest.mark.parametrize("chunk_size", [7, 64, 1000])
+@pytest.mark.parametrize("name", list(documents))
+def test_stream_matches_whole_document(name, chunk_size, lookahead, monkeypatch):
+    monkeypatch.setattr(mml_converter, "stream_lookahead", lookahead)
+    document = documents[name]
+    assert compile_streamed(document, chunk_size) == compile_whole(document)